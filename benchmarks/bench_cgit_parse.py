@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Cgit index page parsing time, full html.parser tree against get_soup with SoupStrainer and lxml.
+
+No html fixtures are bundled, the index page is generated in the layout of
+git.yoctoproject.org with sections and thousands of rows.
+
+Usage: python benchmarks/bench_cgit_parse.py [rows] [rounds]
+"""
+
+import sys
+import time
+import importlib.util
+from urllib.parse import urljoin
+from os.path import dirname, abspath
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from bs4 import BeautifulSoup, SoupStrainer
+from repository import parser
+from repository.parser import Cgit, Meta
+from repository.minisetting import Setting
+
+SOURCE = 'https://git.yoctoproject.org/cgit/cgit.cgi/'
+
+
+def new_index_page(rows):
+    lines = ["<html><head><title>Yocto Project Git Repositories</title></head><body>",
+             "<table id='header'><tr><td class='main'>Yocto Project Git Repositories</td></tr></table>",
+             "<table class='tabs'><tr><td><a class='active' href='/cgit/cgit.cgi/'>index</a></td></tr></table>",
+             "<div class='content'><table summary='repository list' class='list nowrap'>",
+             "<tr class='nohover'><th class='left'>Name</th><th class='left'>Description</th>"
+             "<th class='left'>Owner</th><th class='left'>Idle</th></tr>"]
+    for index in range(rows):
+        if index % 50 == 0:
+            lines.append("<tr class='nohover-highlight'><td colspan='4' class='reposection'>"
+                         "Section {}</td></tr>".format(index // 50))
+        lines.append("<tr><td class='sublevel-repo'><a title='repo{0}' href='/cgit/cgit.cgi/repo{0}/'>repo{0}</a></td>"
+                     "<td><a href='/cgit/cgit.cgi/repo{0}/'>Description of repository {0}</a></td>"
+                     "<td><a href='/cgit/cgit.cgi/?q=owner'>owner</a></td>"
+                     "<td><span class='age-days'>{1} days</span></td></tr>".format(index, index % 30))
+    lines.append("</table></div><div class='footer'>generated by cgit</div></body></html>")
+    return "\n".join(lines)
+
+
+def parse_previous(html):
+    # previous implementation: whole document with html.parser, table walked three times
+    meta_index = Meta()
+    meta_index['source'] = SOURCE
+    soup = BeautifulSoup(html, 'html.parser')
+    table_list = soup.find('table', attrs={'class': 'list nowrap'})
+    offset_page = len(table_list.find_all('tr')) - \
+        len(table_list.find_all('tr', attrs={'class': ['nohover', 'nohover-highlight']}))
+    table = soup.find('table', attrs={'class': 'list nowrap'})
+    names = []
+    section = ""
+    for row in table.find_all('tr'):
+        meta_repository = meta_index.partial_copy()
+        cols = row.find_all('td')
+        if len(cols) == 0:
+            ths = row.find_all('th')
+            for idx, th in enumerate(ths):
+                th = th.text.strip()
+                if th == "Name":
+                    name_index = idx
+                elif th == "Description":
+                    description_index = idx
+                elif th == "Owner":
+                    owner_index = idx
+            continue
+        if len(cols) == 1:
+            section = cols[0].text.strip()
+            continue
+        url = ""
+        for link in cols[name_index].find_all('a', href=True):
+            url = urljoin(meta_repository['source'], link['href'])
+        cols = [ele.text.strip() for ele in cols]
+        meta_repository['section'] = section
+        meta_repository['name'] = cols[name_index]
+        meta_repository['descriptions'] = cols[description_index]
+        meta_repository['owner'] = cols[owner_index]
+        meta_repository['url'] = url
+        names.append(meta_repository['name'])
+    return offset_page, names
+
+
+def parse_current(cgit, html):
+    meta_index = Meta()
+    meta_index['source'] = SOURCE
+    soup = cgit.get_index_soup(html)
+    metas, count = cgit.parse_index_table(meta_index, soup.find('table', attrs={'class': 'list nowrap'}))
+    return count, [meta['name'] for meta in metas]
+
+
+def get_type_previous(html):
+    soup = BeautifulSoup(html, 'html.parser')
+    return soup.find('table', attrs={'class': 'tabs'}).find('td').text.strip()
+
+
+def get_type_current(cgit, html):
+    soup = cgit.get_soup(html, SoupStrainer('table', attrs={'class': 'tabs'}))
+    return soup.find('table', attrs={'class': 'tabs'}).find('td').text.strip()
+
+
+def measure(fn, rounds):
+    best = None
+    result = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    html = new_index_page(rows)
+    setting = Setting()
+    setting['LOG_ENABLED'] = False
+    cgit = Cgit(setting)
+
+    backends = ['html.parser']
+    if importlib.util.find_spec('lxml'):
+        backends.append('lxml')
+    else:
+        print("lxml not installed, skipped")
+    cases = [
+        # index pages are strained with lxml only
+        ("index table", lambda: parse_previous(html), lambda: parse_current(cgit, html)),
+        ("source type", lambda: get_type_previous(html), lambda: get_type_current(cgit, html)),
+    ]
+    for name, previous, current in cases:
+        baseline, expected = measure(previous, rounds)
+        print("{:<12} {:<24} {:>8.1f} ms".format(name, "previous html.parser", baseline * 1000))
+        for backend in backends:
+            parser.HTML_PARSER = backend
+            elapsed, result = measure(current, rounds)
+            assert result == expected, "{} results differ".format(backend)
+            print("{:<12} {:<24} {:>8.1f} ms  x{:.1f}".format(name, backend + " current", elapsed * 1000,
+                                                           baseline / elapsed))
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Startup time of read-only gitmirror.py commands, measured with python -X importtime.
+
+Each command is run in a fresh interpreter. Import time of the repository
+package must stay under the budget, and http and html dependencies must not be
+imported at all. Exit status is 1 if any command is over budget.
+
+Usage: python benchmarks/bench_startup.py [budget ms] [runs]
+"""
+
+import sys
+import time
+import subprocess
+from os.path import join, dirname, abspath
+
+CMD = join(dirname(dirname(abspath(__file__))), 'gitmirror.py')
+COMMANDS = [
+    ['--list'],
+    ['--get', 'configs', 'example'],
+    ['--get', 'repos', 'example'],
+]
+HEAVY_MODULES = ('requests', 'urllib3', 'bs4', 'repository.parser', 'repository.mirror', 'repository.downloader')
+
+
+def run(args):
+    start = time.perf_counter()
+    ret = subprocess.run([sys.executable, '-X', 'importtime', CMD, '--nolog'] + args,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    elapsed = time.perf_counter() - start
+    imported = {}
+    for line in ret.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        imported[name.strip()] = int(cumulative)
+    return elapsed, imported
+
+
+if __name__ == '__main__':
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else 60
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    failed = False
+    for args in COMMANDS:
+        results = [run(args) for _ in range(runs)]
+        elapsed = min(result[0] for result in results)
+        import_time = min(result[1].get('repository', 0) for result in results) / 1000
+        heavy = sorted(name for name in HEAVY_MODULES if name in results[0][1])
+        over = import_time > budget or heavy
+        failed = failed or over
+        print("{:<24} wall {:>6.1f} ms  repository import {:>6.1f} ms  {}".format(
+            ' '.join(args), elapsed * 1000, import_time, 'OVER BUDGET' if over else 'ok'))
+        if heavy:
+            print("    imported: {}".format(', '.join(heavy)))
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Commit throughput of RepositoryStore with rollback journal and with WAL.
+
+Usage: python benchmarks/bench_store.py [repositories]
+"""
+
+import sys
+import time
+import tempfile
+from os.path import join, dirname, abspath
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from repository.minisetting import Setting
+from repository.store import RepositoryStore, Repository
+
+SQL_FILE = join(dirname(dirname(abspath(__file__))), 'tests', 'test_data', 'github.sql')
+
+
+def new_repository(index):
+    repository = Repository()
+    repository['name'] = 'repo{}'.format(index)
+    repository['html_url'] = 'https://github.com/bench/repo{}'.format(index)
+    repository['clone_url'] = 'https://github.com/bench/repo{}.git'.format(index)
+    repository['source'] = 'bench'
+    repository['source_type'] = 'index'
+    return repository
+
+
+def run(count, wal_enabled):
+    setting = Setting()
+    setting['DATABASE_WAL_ENABLED'] = wal_enabled
+    with tempfile.TemporaryDirectory() as temp_dir:
+        sqlite_file = join(temp_dir, 'bench.db')
+        with RepositoryStore(setting) as store:
+            store.create(SQL_FILE, sqlite_file)
+            start = time.perf_counter()
+            # one commit per repository
+            for index in range(count):
+                store.add_repository(sqlite_file, new_repository(index))
+            for repository in store.get_repository_list(sqlite_file):
+                store.update_update_time(sqlite_file, repository['id'])
+            elapsed = time.perf_counter() - start
+            mode = store.open(sqlite_file).execute("PRAGMA journal_mode").fetchone()[0]
+    return mode, count * 2 / elapsed
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    for wal_enabled in (False, True):
+        mode, throughput = run(count, wal_enabled)
+        print("journal_mode={:<8} {:>10.0f} commits/s".format(mode, throughput))
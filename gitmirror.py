@@ -4,6 +4,7 @@
 import sys
 import os
 import optparse
+import signal
 from repository.utils import get_version, set_logger
 from repository import RepositoryManager
 from repository.minisetting import Setting
@@ -40,6 +41,12 @@ def process(options, args):
     if options.nolog:
         set_logger(setting, log_enable=False)
 
+    if options.nocache:
+        setting['HTTP_CACHE_ENABLED'] = False
+
+    if options.incremental:
+        setting['PARSE_INCREMENTAL'] = True
+
     repo_manager = RepositoryManager(setting)
 
     if options.list:
@@ -112,6 +119,16 @@ def process(options, args):
             return False
         repo_manager.init()
         return True
+    if options.daemon:
+        if len(args) > 0:
+            usage_error("--daemon take no argument")
+            return False
+        # pulls in parsers and mirror, only when needed
+        from repository.daemon import ServiceDaemon
+        daemon = ServiceDaemon(setting)
+        signal.signal(signal.SIGTERM, daemon.stop)
+        daemon.run()
+        return True
 
 def cli(argv=None):
     print_cmd_header()
@@ -130,6 +147,10 @@ def cli(argv=None):
                      help="log level (default: DEBUG)")
     group_global.add_option("--nolog", action="store_true",
                      help="disable logging completely")
+    group_global.add_option("--nocache", action="store_true",
+                     help="bypass http response cache")
+    group_global.add_option("--incremental", action="store_true",
+                     help="parse only repositories updated since last parse")
     parser.add_option_group(group_global)
 
     parser.add_option("--list", action='store_true', dest='list',
@@ -152,6 +173,8 @@ def cli(argv=None):
                       help="Run parse and mirror for <service name>")
     group_devspace.add_option("--init", action='store_true', dest="init",
                       help="For devspace init all service and first checkout")
+    group_devspace.add_option("--daemon", action='store_true', dest="daemon",
+                      help="Run all services by their crontab in one process")
     parser.add_option_group(group_devspace)
 
     if len(argv) == 1:
@@ -10,26 +10,74 @@ import filecmp
 import subprocess
 import logging
 import platform
+import importlib
 from .minisetting import Setting
 from .store import RepositoryStore
-from .parser import Cgit, GitHub, Gitee, ParserError
-from .mirror import RepositoryMirror
 from .utils import config_logging
 
+# parsers, downloader and mirror pull in requests and bs4, they are imported
+# on first use so read-only commands start fast
+_LAZY_IMPORTS = {
+    'Cgit': '.parser',
+    'GitHub': '.parser',
+    'Gitee': '.parser',
+    'ParserError': '.parser',
+    'Downloader': '.downloader',
+    'RepositoryMirror': '.mirror',
+}
+
+
+def __getattr__(name):
+    if name in _LAZY_IMPORTS:
+        module = importlib.import_module(_LAZY_IMPORTS[name], __name__)
+        return getattr(module, name)
+    raise AttributeError("module {} has no attribute {}".format(__name__, name))
+
 # logger = logging.getLogger('RepositoryManager')
 
 class RepositoryManager:
-    def __init__(self, setting: Setting = None):
+    def __init__(self, setting: Setting = None, downloader=None, executor=None, host_limits=None):
+        """
+        :param downloader: http session shared with other managers, own one if not given
+        :param executor: mirror worker pool shared with other managers, own one per sync if not given
+        :param host_limits: mirror jobs per host shared with other managers, own ones per sync if not given
+        """
         self.setting = Setting() if not setting else setting
         config_logging(self.setting)
         self.store = RepositoryStore(setting)
-        self.parsers = {
-            'cgit': Cgit(setting),
-            'github': GitHub(setting),
-            'gitee': Gitee(setting)
-        }
-        self.mirror = RepositoryMirror(setting)
+        # built on first use, see properties below
+        self._downloader = downloader
+        self._parsers = None
+        self._mirror = None
+        self.executor = executor
+        self.host_limits = host_limits
         self.logger = logging.getLogger(self.__class__.__name__)
+
+    @property
+    def downloader(self):
+        # one pooled http session for all parsers
+        if self._downloader is None:
+            from .downloader import Downloader
+            self._downloader = Downloader(self.setting)
+        return self._downloader
+
+    @property
+    def parsers(self):
+        if self._parsers is None:
+            from .parser import Cgit, GitHub, Gitee
+            self._parsers = {
+                'cgit': Cgit(self.setting, self.downloader),
+                'github': GitHub(self.setting, self.downloader),
+                'gitee': Gitee(self.setting, self.downloader)
+            }
+        return self._parsers
+
+    @property
+    def mirror(self):
+        if self._mirror is None:
+            from .mirror import RepositoryMirror
+            self._mirror = RepositoryMirror(self.setting, self.executor, self.host_limits)
+        return self._mirror
     
     def git_timeout_config(self):
         speed = self.setting['GIT_LOW_SPEED'] if self.setting['GIT_LOW_SPEED'] else 1000
@@ -76,7 +124,7 @@ class RepositoryManager:
             return False
         str_time = ('_' + '_'.join(backup_sql_name.split('_')[1:3])).split('.')[0]
         backup_sqlite_file = join(self.setting['DB_BACKUP_DIR'], service_name + str_time + '.db')
-        move(sqlite_file, backup_sqlite_file)
+        self.store.move_database(sqlite_file, backup_sqlite_file)
         return True
     
     def backup_sql_file(self, service_name: str):
@@ -91,7 +139,7 @@ class RepositoryManager:
             move(sql_file, dst_file)
         except Exception as e:
             if exists(sqlite_file):
-                os.remove(sqlite_file)
+                self.store.remove_database(sqlite_file)
                 self.logger.error('failed: {}'.format(str(e)))
             return False
         return True
@@ -149,7 +197,7 @@ class RepositoryManager:
             self.store.create(sql_file, sqlite_file)
         except Exception as e:
             if exists(sqlite_file):
-                os.remove(sqlite_file)
+                self.store.remove_database(sqlite_file)
             self.logger.error('db failed: {}'.format(str(e)))
             return False
         if self.backup_sql_file(service_name):
@@ -161,33 +209,41 @@ class RepositoryManager:
 
     def parse_service(self, service_name: str):
         self.logger.info("parse service <{}>".format(service_name))
-        repo_list = []
         if not self.service_name_available(service_name):
             return False
         sqlite_file = self._get_sqlite_file(service_name)
-        status_path = self.setting['LOG_DIR']
-        if not exists(status_path):
-            os.mkdir(status_path)
+        repositories = self._get_repositories_sources(sqlite_file)
+        if not repositories:
+            return False
+        repo_list = list(self._parse_repositories(sqlite_file, repositories))
+        return repo_list if repo_list else False
+
+    def _get_repositories_sources(self, sqlite_file: str):
+        """
+        :returns: repositories sources by parser type, empty if failed
+        """
         try:
             repositories = self.store.get_repositories(sqlite_file)
         except Exception as e:
             self.logger.error('failed: {}'.format(str(e)))
-            return False
-        if repositories:
-            repositories = json.loads(repositories)
-            for repositories_type, repositories_sources in repositories.items():
-                if repositories_type in self.parsers:
-                    if repositories_sources:
-                            for repo in self.parsers[repositories_type].parse(repositories_sources, sqlite_file,
-                                                                              status_path):
-                                repo_list.append(repo)
-                else:
-                    self.logger.error("failed: Unsupport parser type: {}".format(repositories_type))
-                    return False
-        else:
+            return {}
+        if not repositories:
             self.logger.info("failed: Empty repository source: {}".format(sqlite_file))
-            return False
-        return repo_list if repo_list else False
+            return {}
+        repositories = json.loads(repositories)
+        for repositories_type in repositories:
+            if repositories_type not in self.parsers:
+                self.logger.error("failed: Unsupport parser type: {}".format(repositories_type))
+                return {}
+        return repositories
+
+    def _parse_repositories(self, sqlite_file: str, repositories: dict):
+        status_path = self.setting['LOG_DIR']
+        os.makedirs(status_path, exist_ok=True)
+        for repositories_type, repositories_sources in repositories.items():
+            if repositories_sources:
+                for repo in self.parsers[repositories_type].parse(repositories_sources, sqlite_file, status_path):
+                    yield repo
 
     def _get_cgit_url(self, service_name='', schema=''):
         cgit_url = ''
@@ -203,7 +259,10 @@ class RepositoryManager:
         cgit_url = cgit_url + service_name
         return cgit_url
 
-    def mirror_service(self, service_name: str):
+    def mirror_service(self, service_name: str, incoming=None):
+        """
+        :param incoming: repositories being parsed, mirrored as soon as they come
+        """
         self.logger.info("mirror service <{}>".format(service_name))
         if not self.service_name_available(service_name):
             return False
@@ -217,7 +276,7 @@ class RepositoryManager:
         if not cgit_url:
             return False
         self.git_timeout_config()
-        self.mirror.sync(data_dir=data_dir, database=sqlite_file, status_path=status_path)
+        self.mirror.sync(data_dir=data_dir, database=sqlite_file, status_path=status_path, incoming=incoming)
         self.logger.info("generate cgitrc for service <{}>".format(service_name))
         self.mirror.generate_cgitrc(data_dir=data_dir, database=sqlite_file,
                                      cgit_url=cgit_url, cgitrc_file=cgitrc_file)
@@ -298,6 +357,22 @@ class RepositoryManager:
             self.logger.info("No cron job found!")
         return True
 
+    def get_crontabs(self):
+        """
+        :returns: {service name: crontab expression} of services with crontab
+        """
+        crontabs = {}
+        services, services_possible = self.get_services_list()
+        for service_name in services:
+            try:
+                cron = self.store.get_crontab(self._get_sqlite_file(service_name))
+            except Exception as e:
+                self.logger.error('failed: {}'.format(str(e)))
+                continue
+            if cron:
+                crontabs[service_name] = cron
+        return crontabs
+
     def autoconf(self):
         services, services_possible = self.get_services_list()
         for service_name in services_possible:
@@ -305,8 +380,14 @@ class RepositoryManager:
         self.set_crontab()
 
     def batchrun_service(self, service_name:str):
-        self.parse_service(service_name)
-        self.mirror_service(service_name)
+        # parse and mirror in one pipeline, repositories are mirrored while parsing goes on
+        self.logger.info("batchrun service <{}>".format(service_name))
+        if not self.service_name_available(service_name):
+            return False
+        sqlite_file = self._get_sqlite_file(service_name)
+        repositories = self._get_repositories_sources(sqlite_file)
+        incoming = self._parse_repositories(sqlite_file, repositories) if repositories else None
+        return self.mirror_service(service_name, incoming=incoming)
     
     def init(self):
         services, services_possible = self.get_services_list()
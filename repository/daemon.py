@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Run services in one long running process, scheduled by their crontab.
+"""
+
+import logging
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from .minisetting import Setting
+from .downloader import Downloader
+from .mirror import HostLimits
+from . import RepositoryManager
+
+
+class CronError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+class CronExpression:
+    """
+    Five fields crontab expression: minute hour day-of-month month day-of-week.
+
+    Fields take numbers, ``*``, ranges ``a-b``, steps ``*/n`` or ``a-b/n`` and
+    lists of them, names of months and days are not supported.
+    """
+    FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression: str):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise CronError("invalid crontab: {}".format(expression))
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, self.weekdays = \
+            [self.parse_field(field, low, high, expression) for field, (low, high) in zip(fields, self.FIELDS)]
+        # 7 is sunday too
+        if 7 in self.weekdays:
+            self.weekdays = (self.weekdays - {7}) | {0}
+        # restricted day of month and day of week match either one
+        self.days_any = fields[2] == '*'
+        self.weekdays_any = fields[4] == '*'
+
+    def parse_field(self, field, low, high, expression=''):
+        values = set()
+        try:
+            for part in field.split(','):
+                step = 1
+                if '/' in part:
+                    part, step = part.split('/', 1)
+                    step = int(step)
+                if part == '*':
+                    start, end = low, high
+                elif '-' in part:
+                    start, end = [int(value) for value in part.split('-', 1)]
+                else:
+                    start = int(part)
+                    end = high if step != 1 else start
+                if step < 1 or start < low or end > high or start > end:
+                    raise ValueError(part)
+                values.update(range(start, end + 1, step))
+        except ValueError:
+            raise CronError("invalid crontab: {}".format(expression))
+        return values
+
+    def match_day(self, time: datetime):
+        in_days = time.day in self.days
+        in_weekdays = time.isoweekday() % 7 in self.weekdays
+        if self.days_any or self.weekdays_any:
+            return in_days and in_weekdays
+        return in_days or in_weekdays
+
+    def match(self, time: datetime):
+        return time.minute in self.minutes and time.hour in self.hours and \
+            time.month in self.months and self.match_day(time)
+
+    def get_next(self, after: datetime):
+        """
+        :returns: first matching minute after the given time
+        """
+        time = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # 29 february may take years
+        limit = time + timedelta(days=366 * 8)
+        while time < limit:
+            if time.month not in self.months:
+                time = (time.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self.match_day(time):
+                time = time.replace(hour=0, minute=0) + timedelta(days=1)
+            elif time.hour not in self.hours:
+                time = time.replace(minute=0) + timedelta(hours=1)
+            elif time.minute not in self.minutes:
+                time += timedelta(minutes=1)
+            else:
+                return time
+        raise CronError("crontab never matches: {}".format(self.expression))
+
+
+class ServiceDaemon:
+    """
+    Batchrun services by crontab of their Configurations.
+
+    A service is never run twice at once, a run still going when the service is
+    due again is skipped. Services run in their own RepositoryManager, so parser
+    and mirror state is not shared, but they share one http session, one
+    mirror worker pool and the mirror jobs per host limit. Crontabs are reloaded from databases on each wake up.
+    """
+
+    def __init__(self, setting: Setting = None):
+        self.setting = setting if setting else Setting()
+        self.downloader = Downloader(self.setting)
+        workers = self.setting['MIRROR_WORKERS'] if self.setting['MIRROR_WORKERS'] else 1
+        self.mirror_executor = ThreadPoolExecutor(max_workers=max(1, int(workers)))
+        service_workers = self.setting['DAEMON_WORKERS'] if self.setting['DAEMON_WORKERS'] else 1
+        self.service_executor = ThreadPoolExecutor(max_workers=max(1, int(service_workers)))
+        host_limit = self.setting['MIRROR_HOST_LIMIT'] if self.setting['MIRROR_HOST_LIMIT'] else 1
+        self.host_limits = HostLimits(max(1, int(host_limit)))
+        self.manager = RepositoryManager(self.setting, self.downloader, self.mirror_executor, self.host_limits)
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.managers = {}
+        # service name -> (crontab, CronExpression, next run)
+        self.schedules = {}
+        self.running = {}
+        self.stop_event = threading.Event()
+
+    def load_schedules(self, now: datetime):
+        schedules = {}
+        for service_name, crontab in self.manager.get_crontabs().items():
+            schedule = self.schedules.get(service_name)
+            if schedule and schedule[0] == crontab:
+                schedules[service_name] = schedule
+                continue
+            try:
+                cron = CronExpression(crontab)
+                schedules[service_name] = (crontab, cron, cron.get_next(now))
+            except CronError as e:
+                self.logger.error("service <{}> failed: {}".format(service_name, e))
+                continue
+            self.logger.info("schedule service <{}> at <{}>, next run {}".format(
+                service_name, crontab, schedules[service_name][2]))
+        self.schedules = schedules
+
+    def start(self, service_name: str):
+        future = self.running.get(service_name)
+        if future and not future.done():
+            self.logger.warning("service <{}> still running, skip this run".format(service_name))
+            return
+        if service_name not in self.managers:
+            self.managers[service_name] = RepositoryManager(self.setting, self.downloader, self.mirror_executor,
+                                                            self.host_limits)
+        self.running[service_name] = self.service_executor.submit(self.run_service, service_name)
+
+    def run_service(self, service_name: str):
+        try:
+            self.managers[service_name].batchrun_service(service_name)
+        except Exception as e:
+            self.logger.exception("service <{}> failed: {}".format(service_name, e))
+
+    def run(self):
+        self.logger.info("daemon started")
+        try:
+            while not self.stop_event.is_set():
+                now = datetime.now()
+                self.load_schedules(now)
+                for service_name, (crontab, cron, next_run) in self.schedules.items():
+                    if next_run <= now:
+                        self.start(service_name)
+                        self.schedules[service_name] = (crontab, cron, cron.get_next(now))
+                wait = 60
+                if self.schedules:
+                    next_run = min(schedule[2] for schedule in self.schedules.values())
+                    wait = min(wait, max(1, (next_run - datetime.now()).total_seconds()))
+                self.stop_event.wait(wait)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.shutdown()
+
+    def stop(self, *args):
+        self.stop_event.set()
+
+    def shutdown(self):
+        self.logger.info("daemon stopping, wait for running services")
+        self.service_executor.shutdown(wait=True)
+        self.mirror_executor.shutdown(wait=True)
+        self.downloader.close()
@@ -0,0 +1,478 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Download pages through one pooled http session shared by all parsers.
+"""
+
+import os
+import json
+import time
+import random
+import threading
+import itertools
+import logging
+import tempfile
+from hashlib import sha1
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from .minisetting import Setting
+from .utils import get_tokens
+
+
+class Page:
+    """
+    Downloaded page, from network or revalidated from cache.
+    """
+
+    def __init__(self, url='', status_code=0, headers=None, text='', from_cache=False):
+        self.url = url
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers if headers else {})
+        self.text = text
+        self.from_cache = from_cache
+
+    def __bool__(self):
+        return self.status_code < 400
+
+
+class ResponseCache:
+    """
+    On disk cache of responses with ETag or Last-Modified, for conditional requests.
+
+    One json file per url, least recently used files are evicted when the cache
+    grows over HTTP_CACHE_MAX_SIZE bytes.
+    """
+
+    def __init__(self, setting: Setting = None):
+        self.setting = setting if setting else Setting()
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.cache_dir = self.setting['CACHE_DIR']
+        self.max_size = self.setting['HTTP_CACHE_MAX_SIZE']
+        self.lock = threading.Lock()
+        self.size = None
+
+    def get_path(self, url):
+        # keyed by url only, tokens rotate between requests and etags of public data are the same for all
+        return os.path.join(self.cache_dir, sha1(url.encode()).hexdigest() + '.json')
+
+    def get(self, url):
+        path = self.get_path(url)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return entry if entry.get('url') == url else None
+
+    def put(self, url, page: Page):
+        entry = {
+            'url': url,
+            'etag': page.headers.get('ETag', ''),
+            'last_modified': page.headers.get('Last-Modified', ''),
+            'headers': dict(page.headers),
+            'text': page.text
+        }
+        path = self.get_path(url)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(temp_path, path)
+            size = os.path.getsize(path)
+        except OSError as e:
+            self.logger.error("write cache failed: {}".format(e))
+            return
+        with self.lock:
+            if self.size is None:
+                self.size = self.get_size()
+            else:
+                self.size += size - old_size
+            if self.size > self.max_size:
+                self.evict()
+
+    def get_size(self):
+        if not os.path.isdir(self.cache_dir):
+            return 0
+        size = 0
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.json'):
+                try:
+                    size += entry.stat().st_size
+                except OSError:
+                    continue
+        return size
+
+    def evict(self):
+        # least recently used first, until under 90% of max size
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith('.json'):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                # removed meanwhile
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+        for _, size, path in entries:
+            if self.size <= self.max_size * 0.9:
+                break
+            try:
+                os.remove(path)
+                self.size -= size
+            except OSError:
+                continue
+
+
+class RateLimiter:
+    """
+    Pace requests by rate limit headers of api responses.
+
+    A budget is kept per (host, token, resource) and shared by all parsers using
+    the same Downloader, rest and graphql apis of github count apart. Requests
+    wait for the reset when a budget is exhausted, and are spread over the time
+    left until reset once it drops under RATE_LIMIT_RESERVE.
+    """
+
+    def __init__(self, setting: Setting = None):
+        self.setting = setting if setting else Setting()
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.lock = threading.Lock()
+        self.budgets = {}
+
+    def get_wait(self, budget, now):
+        if budget['blocked_until'] > now:
+            return budget['blocked_until'] - now
+        if budget['remaining'] is None:
+            return 0
+        if budget['reset'] <= now:
+            # budget refilled, unknown until next response
+            budget['remaining'] = None
+            return 0
+        if budget['remaining'] <= 0:
+            return budget['reset'] - now
+        if budget['remaining'] < self.setting['RATE_LIMIT_RESERVE']:
+            interval = (budget['reset'] - now) / budget['remaining']
+            return budget['last'] + interval - now
+        return 0
+
+    def acquire(self, key):
+        """
+        Block until a request may be sent.
+
+        :param key: (host, token, resource)
+        :returns: seconds waited
+        """
+        waited = 0
+        while True:
+            with self.lock:
+                budget = self.budgets.setdefault(key, {'remaining': None, 'reset': 0, 'blocked_until': 0, 'last': 0})
+                now = time.time()
+                wait = self.get_wait(budget, now)
+                if wait <= 0:
+                    if budget['remaining'] is not None:
+                        budget['remaining'] -= 1
+                    budget['last'] = now
+                    return waited
+            if wait > 1:
+                self.logger.info("rate limit of {} reached, wait {:.0f}s".format(key[0], wait))
+            # wake up regularly, other requests may update the budget
+            time.sleep(min(wait, 60))
+            waited += min(wait, 60)
+
+    def get_headroom(self, key):
+        """
+        :param key: (host, token, resource)
+        :returns: requests left before wait, infinity if not known yet
+        """
+        with self.lock:
+            budget = self.budgets.get(key)
+            if not budget:
+                return float('inf')
+            now = time.time()
+            if self.get_wait(budget, now) > 0:
+                return -1
+            return float('inf') if budget['remaining'] is None else budget['remaining']
+
+    def get_retry_after(self, headers, now):
+        retry_after = headers.get('Retry-After', '')
+        if retry_after.isdigit():
+            return int(retry_after)
+        if retry_after:
+            try:
+                return max(0, parsedate_to_datetime(retry_after).timestamp() - now)
+            except (TypeError, ValueError):
+                pass
+        return 0
+
+    def update(self, key, status_code, headers, text=''):
+        """
+        Update budget from response.
+
+        :param key: (host, token, resource)
+        :returns: True if request was rejected by rate limit and should be sent again
+        """
+        now = time.time()
+        # response tells which budget it counted against
+        resource = headers.get('X-RateLimit-Resource', '')
+        if resource:
+            key = key[:2] + (resource,)
+        remaining = headers.get('X-RateLimit-Remaining', '')
+        reset = headers.get('X-RateLimit-Reset', '')
+        limited = False
+        with self.lock:
+            budget = self.budgets.setdefault(key, {'remaining': None, 'reset': 0, 'blocked_until': 0, 'last': 0})
+            if remaining.isdigit() and reset.isdigit():
+                budget['remaining'] = int(remaining)
+                budget['reset'] = int(reset)
+            if status_code in (403, 429):
+                retry_after = self.get_retry_after(headers, now)
+                if retry_after:
+                    budget['blocked_until'] = now + retry_after
+                    limited = True
+                elif remaining == '0':
+                    limited = True
+                elif 'secondary rate limit' in text:
+                    # no Retry-After given, github asks to wait at least one minute
+                    budget['blocked_until'] = now + 60
+                    limited = True
+        return limited
+
+
+class RetryPolicy:
+    """
+    Decide if and when a failed request is sent again.
+
+    Connection errors, timeouts and 429/502/503/504 are retried with exponential
+    backoff and full jitter, other status codes like 404 are not. Nothing is
+    retried past REQUESTS_RETRY_DEADLINE seconds after the first attempt, not
+    counting time waited for rate limits.
+    """
+    RETRY_STATUS = (429, 502, 503, 504)
+    RETRY_ERRORS = (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError)
+
+    def __init__(self, setting: Setting = None):
+        self.setting = setting if setting else Setting()
+
+    def is_retryable(self, error=None, status_code=0):
+        if error is not None:
+            return isinstance(error, self.RETRY_ERRORS)
+        return status_code in self.RETRY_STATUS
+
+    def get_backoff(self, attempt):
+        ceiling = min(self.setting['REQUESTS_RETRY_MAX_INTERVAL'],
+                      self.setting['REQUESTS_RETRY_INTERVAL'] * 2 ** attempt)
+        return random.uniform(0, ceiling)
+
+    def get_wait(self, attempt, start, error=None, status_code=0):
+        """
+        :param attempt: retries already done
+        :param start: time.monotonic() of first attempt, moved on by rate limit waits
+        :returns: seconds to wait before retry, None to give up
+        """
+        if not self.setting['REQUESTS_RETRY_ENABLED'] or attempt >= self.setting['REQUESTS_RETRY_TIMES']:
+            return None
+        if not self.is_retryable(error, status_code):
+            return None
+        wait = self.get_backoff(attempt)
+        if time.monotonic() + wait - start > self.setting['REQUESTS_RETRY_DEADLINE']:
+            return None
+        return wait
+
+
+class Downloader:
+    def __init__(self, setting: Setting = None):
+        self.setting = setting if setting else Setting()
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.session = None
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.slots = threading.BoundedSemaphore(max(1, int(self.setting['REQUESTS_WORKERS'])))
+        self.cache = ResponseCache(self.setting) if self.setting['HTTP_CACHE_ENABLED'] else None
+        self.rate_limiter = RateLimiter(self.setting)
+        self.retry_policy = RetryPolicy(self.setting)
+        # token type -> tokens, token files are read once
+        self.tokens = {}
+        self.token_counter = itertools.count()
+
+    def get_session(self):
+        """
+        Create the session on first use, connections are kept alive and pooled per host.
+        """
+        with self.lock:
+            if not self.session:
+                pool_size = self.setting['REQUESTS_POOL_SIZE']
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.session = session
+            return self.session
+
+    def get_tokens(self, token_type):
+        with self.lock:
+            if token_type not in self.tokens:
+                self.tokens[token_type] = get_tokens(self.setting, token_type)
+                if len(self.tokens[token_type]) > 1:
+                    self.logger.info("{} {} tokens in pool".format(len(self.tokens[token_type]), token_type))
+            return self.tokens[token_type]
+
+    def get_auth(self, token_type, url):
+        """
+        Choose the token with most remaining quota on the host of url.
+
+        Tokens are tried in rotation, so tokens of unknown quota are used in turn.
+
+        :returns: (user, token), empty if no token
+        """
+        tokens = self.get_tokens(token_type)
+        if len(tokens) <= 1:
+            return tokens[0] if tokens else ()
+        start = next(self.token_counter) % len(tokens)
+        candidates = tokens[start:] + tokens[:start]
+        return max(candidates, key=lambda token: self.rate_limiter.get_headroom(self.get_rate_key(url, token)))
+
+    def get_rate_key(self, url, auth=None):
+        """
+        :returns: (host, token, resource), graphql and search apis have their own budget
+        """
+        parsed_url = urlparse(url)
+        resource = 'core'
+        if parsed_url.path.rstrip('/').endswith('/graphql'):
+            resource = 'graphql'
+        elif '/search/' in parsed_url.path:
+            resource = 'search'
+        return parsed_url.netloc, auth[1] if auth else '', resource
+
+    def send(self, method, url, headers=None, auth=None, json_data=None):
+        """
+        Send the request, paced by rate limiter and retried by retry policy.
+
+        :returns: response with body loaded
+        """
+        session = self.get_session()
+        # quota belongs to the token, a user may have several
+        rate_key = self.get_rate_key(url, auth)
+        start = time.monotonic()
+        attempt = 0
+        limited = 0
+        while True:
+            # retry deadline doesn't count rate limit waits
+            start += self.rate_limiter.acquire(rate_key)
+            try:
+                # requests in flight are limited over all parsers sharing this downloader
+                with self.slots:
+                    response = session.request(method, url, headers=headers, auth=auth if auth else None,
+                                               json=json_data,
+                                               timeout=(self.setting['REQUESTS_CONNECTION_TIMEOUT'],
+                                                        self.setting['REQUESTS_READ_TIMEOUT']))
+            except requests.exceptions.RequestException as e:
+                wait = self.retry_policy.get_wait(attempt, start, error=e)
+                if wait is None:
+                    raise
+                self.logger.warning("{}, retry in {:.1f}s".format(e, wait))
+                attempt += 1
+                time.sleep(wait)
+                continue
+            response.encoding = 'utf-8'
+            with self.lock:
+                self.requests += 1
+            text = response.text if response.status_code == 403 else ''
+            # rate limit waits are paced by limiter and don't count as retry
+            if self.rate_limiter.update(rate_key, response.status_code, response.headers, text) and \
+                    limited < self.setting['RATE_LIMIT_RETRY_TIMES']:
+                limited += 1
+                response.close()
+                self.logger.warning("rate limited: {}".format(url))
+                continue
+            wait = self.retry_policy.get_wait(attempt, start, status_code=response.status_code)
+            if wait is None:
+                break
+            response.close()
+            self.logger.warning("{} {}, retry in {:.1f}s".format(response.status_code, url, wait))
+            attempt += 1
+            time.sleep(wait)
+        # load body before connection goes back to pool
+        response.text
+        response.close()
+        return response
+
+    def get(self, url, headers=None, auth=None):
+        """
+        Get the url, revalidate cached response with a conditional request if any.
+
+        :param url: url to get
+        :param headers: request headers
+        :param auth: (user, token) or empty
+        :returns: Page
+        """
+        headers = dict(headers) if headers else {}
+        entry = self.cache.get(url) if self.cache else None
+        if entry:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        response = self.send('GET', url, headers, auth)
+        if entry and response.status_code == 304:
+            page_headers = CaseInsensitiveDict(entry['headers'])
+            page_headers.update(response.headers)
+            self.logger.debug("not modified: {}".format(url))
+            return Page(url, 200, page_headers, entry['text'], from_cache=True)
+        page = Page(url, response.status_code, response.headers, response.text)
+        if self.cache and response.status_code == 200 and \
+                ('ETag' in response.headers or 'Last-Modified' in response.headers):
+            self.cache.put(url, page)
+        return page
+
+    def post(self, url, json_data, headers=None, auth=None):
+        """
+        Post json to the url, responses are never cached.
+
+        :param url: url to post
+        :param json_data: json serializable request body
+        :param headers: request headers
+        :param auth: (user, token) or empty
+        :returns: Page
+        """
+        response = self.send('POST', url, headers, auth, json_data)
+        return Page(url, response.status_code, response.headers, response.text)
+
+    def head(self, url, headers=None, auth=None):
+        """
+        Check the url without body, responses are never cached.
+
+        :returns: Page
+        """
+        response = self.send('HEAD', url, headers, auth)
+        return Page(url, response.status_code, response.headers)
+
+    def get_stats(self):
+        """
+        :returns: (requests sent, connections opened) since session created
+        """
+        opened = 0
+        with self.lock:
+            requests_count = self.requests
+            if self.session:
+                for adapter in set(self.session.adapters.values()):
+                    pools = adapter.poolmanager.pools
+                    for key in pools.keys():
+                        opened += pools[key].num_connections
+        return requests_count, opened
+
+    def close(self):
+        with self.lock:
+            if self.session:
+                self.session.close()
+                self.session = None
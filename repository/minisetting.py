@@ -18,19 +18,45 @@ class Setting:
             "LOG_DIR": join(dirname(dirname(abspath(__file__))), "log"),
             "REQUESTS_CONNECTION_TIMEOUT": 3,
             "REQUESTS_READ_TIMEOUT": 10,
-            "REQUESTS_RETRY_ENABLED": False,
+            "REQUESTS_RETRY_ENABLED": True,
             "REQUESTS_RETRY_TIMES": 3,
             "REQUESTS_RETRY_INTERVAL": 3,
+            "REQUESTS_RETRY_MAX_INTERVAL": 30,
+            "REQUESTS_RETRY_DEADLINE": 60,
+            "REQUESTS_POOL_SIZE": 10,
+            "REQUESTS_WORKERS": 8,
+            "PARSE_CONCURRENCY": 8,
+            "PARSE_INCREMENTAL": False,
+            "PARSE_FULL_SCAN_INTERVAL": 86400,
+            "GITHUB_GRAPHQL_ENABLED": False,
+            "GITHUB_GRAPHQL_BATCH_SIZE": 100,
+            "RATE_LIMIT_RESERVE": 100,
+            "RATE_LIMIT_RETRY_TIMES": 3,
+            "HTTP_CACHE_ENABLED": True,
+            "HTTP_CACHE_MAX_SIZE": 104857600,
+            "CACHE_DIR": join(dirname(dirname(abspath(__file__))), "cache"),
             "ENABLE_DEFAULT_SECTION": True,
             "DEFAULT_SECTION_NAME": "Unclassified",
             "GIT_LOW_SPEED": 1000,
             "GIT_LOW_TIMEOUT": 60,
+            "MIRROR_WORKERS": 8,
+            "MIRROR_HOST_LIMIT": 4,
+            "MIRROR_SKIP_UNCHANGED": True,
+            "MIRROR_QUEUE_SIZE": 100,
+            "MAINTENANCE_ENABLED": True,
+            "MAINTENANCE_INTERVAL": 86400,
+            "MAINTENANCE_TIME_BUDGET": 240,
+            "DATABASE_BATCH_SIZE": 100,
+            "DATABASE_WAL_ENABLED": True,
+            "DATABASE_CACHE_SIZE": 8192,
+            "DATABASE_MMAP_SIZE": 67108864,
             "DATABASE_DIR": join(dirname(dirname(abspath(__file__))), "database"),
             "BACKUP_DIR": join(dirname(dirname(abspath(__file__))), "backup"),
             "DB_BACKUP_DIR": join(dirname(dirname(abspath(__file__))), "backup/database"),
             "REPOS_BACKUP_DIR": join(dirname(dirname(abspath(__file__))), "backup/repositories"),
             "DATA_DIR": '/srv/git',
-            "CRON_FILE": join(dirname(dirname(abspath(__file__))), "crontab")
+            "CRON_FILE": join(dirname(dirname(abspath(__file__))), "crontab"),
+            "DAEMON_WORKERS": 4
         }
 
     def __getitem__(self, name):
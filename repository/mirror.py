@@ -11,10 +11,21 @@ import os
 from os.path import join, exists, isdir, abspath, normpath, basename, dirname
 import json
 import shutil
+import tempfile
 import subprocess
 import time
 import logging
-from hashlib import md5
+import threading
+from collections import deque
+from queue import Queue, Empty, Full
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from hashlib import md5, sha1
+from urllib.parse import urlparse
+try:
+    import fcntl
+except ImportError:
+    # no file lock on windows
+    fcntl = None
 
 from .minisetting import Setting
 from .store import Repository, RepositoryStore
@@ -28,12 +39,135 @@ class MirrorError(Exception):
         return self.msg
 
 
+def get_host_from_url(url: str):
+    """
+    Get host name from a clone url.
+
+    :param url: clone url, scp-like syntax ``user@host:path`` is supported
+    :returns: host name, empty for local path
+    """
+    host = urlparse(url).hostname
+    if host:
+        return host
+    if '@' in url and ':' in url:
+        return url.split('@', 1)[1].split(':', 1)[0]
+    return ''
+
+
+class HostLimits:
+    """
+    Jobs in flight per host, shared by schedulers of all services of a process.
+    """
+
+    def __init__(self, host_limit=1):
+        self.host_limit = host_limit
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, host):
+        """
+        :returns: False if host has host_limit jobs in flight already
+        """
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(self.host_limit)
+            semaphore = self.semaphores[host]
+        return semaphore.acquire(blocking=False)
+
+    def release(self, host):
+        self.semaphores[host].release()
+
+
+class MirrorScheduler:
+    """
+    Dispatch mirror jobs to a worker pool.
+
+    Jobs are queued per host and hosts are served round-robin, a host never has
+    more than ``host_limit`` jobs in flight, jobs of other schedulers sharing
+    ``host_limits`` included.
+    """
+
+    def __init__(self, executor, workers=1, host_limit=1, host_limits: HostLimits = None):
+        self.executor = executor
+        self.workers = workers
+        self.host_limits = host_limits if host_limits else HostLimits(host_limit)
+        self.hosts = deque()
+        self.queues = {}
+        self.futures = {}
+
+    def add(self, host, item, fn, *args):
+        if host not in self.queues:
+            self.queues[host] = deque()
+            self.hosts.append(host)
+        self.queues[host].append((item, fn, args))
+
+    def pending(self):
+        return bool(self.futures) or bool(self.hosts)
+
+    def queued(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def dispatch(self):
+        blocked = 0
+        while self.hosts and len(self.futures) < self.workers and blocked < len(self.hosts):
+            host = self.hosts.popleft()
+            if not self.host_limits.acquire(host):
+                self.hosts.append(host)
+                blocked += 1
+                continue
+            blocked = 0
+            item, fn, args = self.queues[host].popleft()
+            if self.queues[host]:
+                self.hosts.append(host)
+            else:
+                del self.queues[host]
+            self.futures[self.executor.submit(fn, *args)] = (host, item)
+
+    def completed(self, timeout=None):
+        """
+        Wait for running jobs.
+
+        :param timeout: seconds to wait, None wait until at least one job finished
+        :yield: (item, future) of finished jobs
+        """
+        if not self.futures:
+            if self.hosts:
+                # hosts are busy with jobs of other schedulers
+                time.sleep(0.1 if timeout is None else min(timeout, 0.1))
+            return
+        done, _ = wait(list(self.futures), timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            host, item = self.futures.pop(future)
+            self.host_limits.release(host)
+            yield item, future
+
+    def run(self):
+        while self.pending():
+            self.dispatch()
+            for item, future in self.completed():
+                yield item, future
+
+
 class RepositoryMirror:
-    def __init__(self, setting: Setting = None):
+    def __init__(self, setting: Setting = None, executor: ThreadPoolExecutor = None, host_limits: HostLimits = None):
         self.setting = setting if setting else Setting()
+        # shared worker pool, own pool per sync if not given
+        self.executor = executor
+        # shared jobs per host, own limits per sync if not given
+        self.host_limits = host_limits
         self.failed_list = []
+        self.failed_lock = threading.Lock()
         self.logger = logging.getLogger(self.__class__.__name__)
         self.mirrored = []
+        self.git_version = None
+
+    def get_workers(self):
+        workers = self.setting['MIRROR_WORKERS'] if self.setting['MIRROR_WORKERS'] else 1
+        return max(1, int(workers))
+
+    def get_host_limit(self):
+        host_limit = self.setting['MIRROR_HOST_LIMIT'] if self.setting['MIRROR_HOST_LIMIT'] else 1
+        return max(1, int(host_limit))
 
     def get_source_dir_from_url(self, source_url: str):
         return md5(source_url.encode()).hexdigest()
@@ -55,10 +189,17 @@ class RepositoryMirror:
         if not error_callback:
             error_callback = self.process_error
         source_path = join(data_dir, self.get_source_dir_from_url(repository['source']))
-        if not exists(source_path):
-            os.mkdir(source_path)
+        # several workers may share the same source directory
+        os.makedirs(source_path, exist_ok=True)
         clone_url = repository["clone_url"].split(',')[0]
         repo_dir = self.get_repository_path(data_dir, repository)
+        fingerprint = self.get_ref_fingerprint(clone_url) if self.setting['MIRROR_SKIP_UNCHANGED'] else ''
+        if fingerprint and isdir(repo_dir) and fingerprint == repository.get('ref_fingerprint'):
+            self.logger.info("Unchanged: {}".format(repository['name']))
+            repository['fetched'] = False
+            return True
+        repository['ref_fingerprint'] = fingerprint
+        repository['fetched'] = True
         if not isdir(repo_dir):
             self.logger.info("Mirror: {}".format(repository['name']))
             ret = subprocess.run(["git", "clone", "--mirror", clone_url, repo_dir], stdout=subprocess.DEVNULL)
@@ -84,6 +225,18 @@ class RepositoryMirror:
         self.export(export_file)
         return True
 
+    def get_ref_fingerprint(self, clone_url: str):
+        """
+        Hash the refs advertised by remote.
+
+        :param clone_url: remote url
+        :returns: sha1 of ``git ls-remote`` output, empty if remote can't be listed
+        """
+        ret = subprocess.run(["git", "ls-remote", clone_url], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if ret.returncode != 0:
+            return ''
+        return sha1(b"\n".join(sorted(ret.stdout.splitlines()))).hexdigest()
+
     def export(self, export_file):
         """
         Mark a repository as exportable.
@@ -114,17 +267,18 @@ class RepositoryMirror:
             source_path = join(data_dir, name)
             if isdir(source_path):
                 files = os.listdir(source_path)
+                source_path = normpath(abspath(source_path)).replace('\\', '/')
                 for file in files:
                     if file.endswith(".git") and file != ".git":
-                        local_repositories.append(normpath(abspath(join(source_path, file))).replace('\\','/'))
+                        local_repositories.append(source_path + '/' + file)
         return local_repositories
 
-    def get_remote_repositories(self, database):
+    def get_remote_repositories(self, database, stale_first=False):
         if not database:
             raise MirrorError("No input database")
         try:
             store = RepositoryStore(self.setting)
-            repositories = store.get_repository_list(database)
+            repositories = store.get_repository_list(database, stale_first)
         except Exception as e:
             raise MirrorError("Read repository source failed: {}".format(str(e)))
         finally:
@@ -132,10 +286,12 @@ class RepositoryMirror:
         return repositories
 
     def process_error(self, error):
-        self.failed_list.append(error)
+        # called from mirror workers
+        with self.failed_lock:
+            self.failed_list.append(error)
         print(error)
 
-    def sync(self, data_dir='', database='', status_path='', consistency=False):
+    def sync(self, data_dir='', database='', status_path='', consistency=False, incoming=None):
         """
         For each repo in the file, either update it if it is already mirrored, or
         mirror it
@@ -145,31 +301,43 @@ class RepositoryMirror:
         :param database: database file
         :param status_path: path to save status file
         :param consistency: delete remotely deleted repositories from our local mirror
+        :param incoming: repositories being parsed into database, mirrored as they come
         """
 
         local_repositories = self.get_local_repositories(data_dir)
-        remote_repositories = self.get_remote_repositories(database)
 
         store = RepositoryStore(self.setting)
 
         self.failed_list = []
-        for repository in remote_repositories:
-            if self.mirror(data_dir, repository):
-                store.update_update_time(database, repository['id'])
+        # git operations run in the worker pool, database updates stay in this thread
+        workers = self.get_workers()
+        executor = self.executor if self.executor else ThreadPoolExecutor(max_workers=workers)
+        try:
+            scheduler = MirrorScheduler(executor, workers, self.get_host_limit(), self.host_limits)
+            scheduled = set()
+            if incoming is not None:
+                self.sync_incoming(scheduler, store, data_dir, database, incoming, scheduled)
+            # repositories not parsed this time, or all of them without incoming
+            # read once, paths are kept for the consistency check
+            remote_paths = set()
+            for repository in self.get_remote_repositories(database, stale_first=True):
+                if consistency:
+                    remote_paths.add(self.get_repository_path(data_dir, repository))
+                if repository['id'] not in scheduled:
+                    self.schedule(scheduler, data_dir, repository)
+            for repository, future in scheduler.run():
+                self.process_result(store, database, repository, future)
+            if self.setting['MAINTENANCE_ENABLED']:
+                self.maintain(data_dir, database, executor)
             # TODO mirroring the repository to a new location 
             # git push --prune git@example.com:/new-location.git +refs/remotes/origin/*:refs/heads/* +refs/tags/*:refs/tags/*
             # git push --mirror git@example.com/new-location.git
-        remote_repositories = [self.get_repository_path(data_dir, remote_repo)
-                               for remote_repo in self.get_remote_repositories(database)]
+        finally:
+            if executor is not self.executor:
+                executor.shutdown(wait=True)
         if consistency:
-            repos_to_move = [repo for repo in local_repositories if repo not in remote_repositories]
-            backup_dir = join(self.setting['BACKUP_DIR'],'repositories')
-            for repo in repos_to_move:
-                repo_name = basename(repo)
-                source_name = basename(dirname(repo))
-                dst = join(join(backup_dir, source_name), repo_name)
-                shutil.move(repo, dst)
-                self.logger.info("Move to backup: {}".format(repo_name))
+            repos_to_move = [repo for repo in local_repositories if repo not in remote_paths]
+            self.quarantine(repos_to_move, join(self.setting['BACKUP_DIR'], 'repositories'))
 
         if status_path:
             name = ''
@@ -177,6 +345,249 @@ class RepositoryMirror:
                 name = basename(database).split('.')[0]
             self.save_status(status_path, name)
 
+    def get_git_version(self):
+        if self.git_version is None:
+            ret = subprocess.run(["git", "--version"], stdout=subprocess.PIPE, universal_newlines=True)
+            version = ret.stdout.split()[2] if ret.returncode == 0 and len(ret.stdout.split()) > 2 else ''
+            self.git_version = tuple(int(part) for part in version.split('.')[:2] if part.isdigit())
+        return self.git_version
+
+    def get_pack_count(self, repo_dir):
+        pack_dir = join(repo_dir, 'objects', 'pack')
+        if not isdir(pack_dir):
+            return 0
+        return sum(1 for file in os.listdir(pack_dir) if file.endswith('.pack'))
+
+    def get_maintenance_tasks(self):
+        """
+        Tasks of ``git maintenance`` run by hand, mirrors are bare and not registered.
+
+        :returns: git arguments of each task, in run order
+        """
+        version = self.get_git_version()
+        # geometric repack only rewrites small packs, else pack loose objects only
+        repack = ["repack", "-d", "-l", "--geometric=2"] if version >= (2, 33) else ["repack", "-d", "-l"]
+        tasks = [["pack-refs", "--all"], repack,
+                 ["commit-graph", "write", "--reachable", "--split"]]
+        if version >= (2, 34):
+            tasks.append(["multi-pack-index", "write", "--bitmap"])
+        else:
+            tasks.append(["multi-pack-index", "write"])
+        return tasks
+
+    def maintain_repository(self, repo_dir, tasks):
+        """
+        :returns: error message of first failed task, empty if all done
+        """
+        for task in tasks:
+            # empty repositories have nothing to index
+            if task[0] == 'multi-pack-index' and not self.get_pack_count(repo_dir):
+                continue
+            ret = subprocess.run(["git", "--git-dir", repo_dir] + task,
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            if ret.returncode != 0:
+                return "git {}: {}".format(task[0], ret.stderr.decode('utf-8', 'replace').strip())
+        return ''
+
+    def maintain(self, data_dir='', database='', executor: ThreadPoolExecutor = None):
+        """
+        Run git maintenance on mirrors not maintained for MAINTENANCE_INTERVAL.
+
+        Mirrors with most packs and most fetches since last maintenance go first,
+        no mirror is started after MAINTENANCE_TIME_BUDGET seconds. Maintenance
+        of a service still running from a previous sync is not started again.
+        """
+        with open(join(data_dir, '.maintenance.lock'), 'w') as lock:
+            if fcntl:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    self.logger.info("maintenance of <{}> still running, skipped".format(data_dir))
+                    return
+            self.run_maintenance(data_dir, database, executor)
+
+    def run_maintenance(self, data_dir, database, executor: ThreadPoolExecutor = None):
+        start = time.monotonic()
+        budget = self.setting['MAINTENANCE_TIME_BUDGET']
+        due = time.strftime("%Y-%m-%d %H:%M:%S",
+                            time.localtime(time.time() - self.setting['MAINTENANCE_INTERVAL']))
+        store = RepositoryStore(self.setting)
+        candidates = []
+        columns = ('id', 'name', 'source', 'fetch_count', 'last_maintenance')
+        for repository in store.iter_repository_list(database, columns):
+            # same format as datetime('now','localtime')
+            if repository['last_maintenance'] and repository['last_maintenance'] > due:
+                continue
+            repo_dir = self.get_repository_path(data_dir, repository)
+            if not isdir(repo_dir):
+                continue
+            priority = (self.get_pack_count(repo_dir), repository['fetch_count'] or 0)
+            candidates.append((priority, repository['id'], repo_dir, repository['name']))
+        if not candidates:
+            return
+        candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+        tasks = self.get_maintenance_tasks()
+        workers = self.get_workers()
+        own_executor = executor is None
+        executor = ThreadPoolExecutor(max_workers=workers) if own_executor else executor
+        self.logger.info("maintain {} repositories".format(len(candidates)))
+        try:
+            futures = {}
+            candidates = deque(candidates)
+            while candidates or futures:
+                while candidates and len(futures) < workers and time.monotonic() - start < budget:
+                    _, repository_id, repo_dir, name = candidates.popleft()
+                    futures[executor.submit(self.maintain_repository, repo_dir, tasks)] = (repository_id, name)
+                if not futures:
+                    break
+                done, _ = wait(list(futures), return_when=FIRST_COMPLETED)
+                for future in done:
+                    repository_id, name = futures.pop(future)
+                    try:
+                        error = future.result()
+                    except Exception as e:
+                        error = str(e)
+                    if error:
+                        self.process_error("Maintenance Failed: {} {}".format(name, error))
+                    else:
+                        self.logger.info("Maintained: {}".format(name))
+                        store.update_maintenance(database, repository_id)
+            if candidates:
+                self.logger.info("maintenance time budget used, {} repositories left".format(len(candidates)))
+        finally:
+            if own_executor:
+                executor.shutdown(wait=True)
+
+    def quarantine(self, repositories, backup_dir):
+        """
+        Move repositories to backup_dir/<source dir>/<name>.
+
+        Moves run in parallel, a rename when backup_dir is on the same file
+        system, a copy otherwise.
+
+        :param repositories: local repository paths
+        """
+        if not repositories:
+            return
+        moves = []
+        for repo in repositories:
+            dst_dir = join(backup_dir, basename(dirname(repo)))
+            dst = join(dst_dir, basename(repo))
+            if exists(dst):
+                dst += time.strftime("_%Y%m%d_%H%M%S", time.localtime())
+            moves.append((repo, dst))
+        for dst_dir in {dirname(dst) for _, dst in moves}:
+            os.makedirs(dst_dir, exist_ok=True)
+        self.logger.info("move {} repositories to backup <{}>".format(len(moves), backup_dir))
+        with ThreadPoolExecutor(max_workers=self.get_workers()) as executor:
+            for repo, error in zip(repositories, executor.map(self.move_repository, moves)):
+                if error:
+                    self.process_error("Move Failed: {} {}".format(repo, error))
+
+    def move_repository(self, move):
+        src, dst = move
+        try:
+            try:
+                os.rename(src, dst)
+            except OSError:
+                # backup dir on another file system
+                shutil.move(src, dst)
+        except (OSError, shutil.Error) as e:
+            return str(e)
+        self.logger.info("Move to backup: {}".format(basename(src)))
+        return ''
+
+    def schedule(self, scheduler: MirrorScheduler, data_dir, repository):
+        host = get_host_from_url(repository['clone_url'].split(',')[0])
+        scheduler.add(host, repository, self.mirror, data_dir, repository)
+
+    def process_result(self, store: RepositoryStore, database, repository, future):
+        try:
+            mirrored = future.result()
+        except Exception as e:
+            self.process_error("Mirror Failed: {} {}".format(repository['name'], str(e)))
+            return
+        if not mirrored:
+            return
+        if repository.get('fetched', True):
+            store.update_mirror_state(database, repository['id'], repository['ref_fingerprint'])
+        else:
+            # fetch skipped, only the check is recorded
+            store.update_check_time(database, repository['id'])
+
+    def sync_incoming(self, scheduler: MirrorScheduler, store: RepositoryStore, data_dir, database, incoming,
+                      scheduled: set):
+        """
+        Mirror repositories while they are parsed.
+
+        Parsing runs in its own thread and hands repositories over a bounded queue,
+        so it waits when mirror falls behind. Repositories are taken from the queue
+        only while the scheduler has room, jobs finish in between. Jobs still
+        running when parsing ends are left in the scheduler.
+
+        :param incoming: iterable of parsed repositories, already stored in database
+        :param scheduled: ids of scheduled repositories, updated
+        """
+        parsed = Queue(maxsize=max(1, self.setting['MIRROR_QUEUE_SIZE']))
+        errors = []
+        stop = threading.Event()
+
+        def put(item):
+            # give up when sync failed, nobody reads the queue anymore
+            while not stop.is_set():
+                try:
+                    parsed.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    continue
+            return False
+
+        def produce():
+            try:
+                for repository in incoming:
+                    if not put(repository):
+                        # stop parsing too
+                        if hasattr(incoming, 'close'):
+                            incoming.close()
+                        break
+            except Exception as e:
+                errors.append(e)
+            finally:
+                put(None)
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            streaming = True
+            while streaming:
+                while streaming and scheduler.queued() < scheduler.workers:
+                    try:
+                        # don't block while jobs are running, their results are handled below
+                        repository = parsed.get(timeout=0.1) if scheduler.futures else parsed.get()
+                    except Empty:
+                        break
+                    if repository is None:
+                        streaming = False
+                        break
+                    # parser only yields stored repositories, read back id and mirror state
+                    stored = Repository()
+                    stored['clone_url'] = repository['clone_url']
+                    record = store.find_duplicate(database, stored)
+                    if not record or record['id'] in scheduled:
+                        continue
+                    scheduled.add(record['id'])
+                    self.schedule(scheduler, data_dir, record)
+                    scheduler.dispatch()
+                for repository, future in scheduler.completed(timeout=0.1 if streaming else None):
+                    self.process_result(store, database, repository, future)
+                # jobs held back by host limit are started when others finish
+                scheduler.dispatch()
+            producer.join()
+        finally:
+            stop.set()
+        for error in errors:
+            self.process_error("Parse Failed: {}".format(str(error)))
+
     def save_status(self, path='', name=''):
         """
         Export repo list to json file
@@ -200,38 +611,77 @@ class RepositoryMirror:
             json.dump(result, f, indent=2, ensure_ascii=False)
 
     def generate_cgitrc(self, data_dir='', database='', cgit_url='', cgitrc_file=''):
-        local_repositories = self.get_local_repositories(data_dir)
-        remote_repositories = self.get_remote_repositories(database)
-
-        cgitrc = []
-        recorded = []
-        for repository in remote_repositories:
-            repo_path = self.get_repository_path(data_dir, repository)
-            if repo_path in local_repositories:
-                name = repository['name']
-                if name not in recorded:
-                    url = name
-                    recorded.append(name)
-                else:
-                    url = '.'.join(repository['owner'], name)
-                if cgit_url:
-                    cgit_url = cgit_url if cgit_url.endswith('/') else cgit_url + '/'
-                    local_url = cgit_url + url
-                    clone_url = "repo.clone-url={} {}\n".format(local_url, repository["clone_url"].split(',')[0])
-                else:
-                    clone_url = "repo.clone-url={}\n".format(repository["clone_url"].split(',')[0])
-                cgitrc.append('repo.url={}\n'.format(url))
-                cgitrc.append('repo.name={}\n'.format(repository['name']))
-                cgitrc.append('repo.desc={}\n'.format(repository['descriptions']))
-                cgitrc.append('repo.owner={}\n'.format(repository["owner"]))
-                cgitrc.append('repo.section={}\n'.format(repository["section"]))
-                cgitrc.append('repo.path={}\n'.format(self.get_repository_path(data_dir, repository)))
-                cgitrc.append(clone_url)
-                cgitrc.append('repo.homepage={}\n'.format(repository['html_url']))
-                cgitrc.append('\n')
-
-        cgitrc = "".join(cgitrc)
-        with open(cgitrc_file, "w", encoding="utf-8") as f:
-            f.write(cgitrc)
+        """
+        Write cgit repo entries of mirrored repositories.
+
+        Entries are streamed from database to a temporary file, which replaces
+        cgitrc_file only if content changed, so cgit cache is kept otherwise.
+
+        :returns: True if cgitrc_file was written
+        """
+        local_repositories = set(self.get_local_repositories(data_dir))
+        if not database:
+            raise MirrorError("No input database")
+        if cgit_url and not cgit_url.endswith('/'):
+            cgit_url += '/'
+        columns = ('name', 'owner', 'descriptions', 'section', 'source', 'clone_url', 'html_url')
+        source_paths = {}
+        recorded = set()
+        cgitrc_dir = dirname(abspath(cgitrc_file))
+        checksum = sha1()
+        fd, temp_file = tempfile.mkstemp(prefix='.' + basename(cgitrc_file), dir=cgitrc_dir)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                store = RepositoryStore(self.setting)
+                try:
+                    for repository in store.iter_repository_list(database, columns):
+                        source = repository['source']
+                        if source not in source_paths:
+                            source_paths[source] = normpath(abspath(
+                                join(data_dir, self.get_source_dir_from_url(source)))).replace('\\', '/')
+                        name = repository['name']
+                        repo_path = source_paths[source] + '/' + (name if name.endswith('.git') else name + '.git')
+                        if repo_path not in local_repositories:
+                            continue
+                        if name not in recorded:
+                            url = name
+                            recorded.add(name)
+                        else:
+                            url = '.'.join((repository['owner'], name))
+                        clone_url = repository["clone_url"].split(',')[0]
+                        if cgit_url:
+                            clone_url = cgit_url + url + ' ' + clone_url
+                        entry = ''.join((
+                            'repo.url={}\n'.format(url),
+                            'repo.name={}\n'.format(name),
+                            'repo.desc={}\n'.format(repository['descriptions']),
+                            'repo.owner={}\n'.format(repository["owner"]),
+                            'repo.section={}\n'.format(repository["section"]),
+                            'repo.path={}\n'.format(repo_path),
+                            'repo.clone-url={}\n'.format(clone_url),
+                            'repo.homepage={}\n'.format(repository['html_url']),
+                            '\n'))
+                        # checksum of what text mode writes to disk
+                        checksum.update(entry.replace('\n', os.linesep).encode('utf-8'))
+                        f.write(entry)
+                finally:
+                    del store
+            if exists(cgitrc_file) and self.get_file_checksum(cgitrc_file) == checksum.hexdigest():
+                self.logger.info("cgitrc <{}> not changed".format(cgitrc_file))
+                return False
+            # mkstemp creates owner only files, cgit needs to read it
+            os.chmod(temp_file, os.stat(cgitrc_file).st_mode if exists(cgitrc_file) else 0o644)
+            os.replace(temp_file, cgitrc_file)
+            return True
+        finally:
+            if exists(temp_file):
+                os.remove(temp_file)
+
+    def get_file_checksum(self, file_name):
+        checksum = sha1()
+        with open(file_name, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                checksum.update(chunk)
+        return checksum.hexdigest()
 
 
@@ -6,16 +6,27 @@ Parser pages and export repo json file.
 """
 
 import os
+import re
+import subprocess
 import json
 import requests
 import time
 import logging
-from bs4 import BeautifulSoup
+import asyncio
+import importlib.util
+import threading
+from collections import deque
+from queue import Queue, Empty
+from concurrent.futures import ThreadPoolExecutor
+from bs4 import BeautifulSoup, SoupStrainer
 from urllib.parse import urljoin, urlparse
 from .minisetting import Setting
-from .utils import get_token
+from .downloader import Downloader
 from .store import Repository, RepositoryStore
 
+# lxml builds trees several times faster, html.parser is the fallback
+HTML_PARSER = 'lxml' if importlib.util.find_spec('lxml') else 'html.parser'
+
 
 class ParserError(Exception):
     def __init__(self, msg):
@@ -31,7 +42,9 @@ class Meta:
             'repository': Repository(),
             'url': '',
             "excludes": [],
+            'clone_url_template': '',
             'html': '',
+            'headers': {},
             'error': ''
         }
 
@@ -72,6 +85,7 @@ class Meta:
     def partial_copy(self):
         copy_meta = Meta()
         copy_meta.meta['excludes'] = self.meta['excludes']
+        copy_meta.meta['clone_url_template'] = self.meta['clone_url_template']
         copy_meta.meta['repository']['target_url'] = self.meta['repository']['target_url']
         copy_meta.meta['repository']['source'] = self.meta['repository']['source']
         copy_meta.meta['repository']['source_type'] = self.meta['repository']['source_type']
@@ -82,19 +96,33 @@ class Meta:
 
 
 class RepositoryParser:
-    def __init__(self, setting: Setting = None):
+    def __init__(self, setting: Setting = None, downloader: Downloader = None):
         self.setting = setting if setting else Setting()
+        self.downloader = downloader if downloader else Downloader(self.setting)
         self.sources = None
         self.failed_list = {}
+        self.failed_lock = threading.Lock()
         self.logger = logging.getLogger(self.__class__.__name__)
-        self.parsed = []
-
-    def download(self, meta: Meta, callback=None):
+        # urls parsed in this run, shared by engine threads
+        self.parsed = set()
+        self.parsed_lock = threading.Lock()
+        self.executor = None
+        self.download_executor = None
+        # parsed repositories handed over from engine threads
+        self.results = None
+        # set when consumer of parse_sources is gone, steps stop between pages
+        self.stopped = threading.Event()
+        # incremental parse state, {source: (watermark, last_full_scan)}
+        self.watermarks = {}
+        self.new_watermarks = {}
+
+    def download(self, meta: Meta, callback=None, json_data=None):
         """
         Download the url.
 
         :param meta: include url and report error in this context
         :param callback: callback function
+        :param json_data: post json_data instead of get if given
         :returns:if use callback return callback result
         """
         
@@ -104,33 +132,21 @@ class RepositoryParser:
         auth = ()
         if 'github' in urlparse(meta['url']).netloc:
             headers['Accept'] = "application/vnd.github.v3+json"
-            auth = get_token(token_type='github')
+            auth = self.downloader.get_auth('github', meta['url'])
         if 'gitee' in urlparse(meta['url']).netloc:
-            auth = get_token(token_type='gitee')
+            auth = self.downloader.get_auth('gitee', meta['url'])
         r = None
-        retry = 0 if self.setting['REQUESTS_RETRY_ENABLED'] else self.setting['REQUESTS_RETRY_TIMES']
-        while retry <= self.setting['REQUESTS_RETRY_TIMES']:
-            try:
-                if auth:
-                    r = requests.get(meta['url'], auth=auth, headers=headers,
-                                    timeout=(self.setting['REQUESTS_CONNECTION_TIMEOUT'],
-                                            self.setting['REQUESTS_READ_TIMEOUT']))
-                else:
-                    r = requests.get(meta['url'], headers=headers,
-                                    timeout=(self.setting['REQUESTS_CONNECTION_TIMEOUT'],
-                                            self.setting['REQUESTS_READ_TIMEOUT']))
-                r.encoding = 'utf-8'
-                # print(r.headers)
-                break
-            except requests.exceptions.RequestException as e:
-                retry += 1
-                self.logger.error(e)
-                time.sleep(self.setting['REQUESTS_RETRY_INTERVAL'])
-            finally:
-                if r:
-                    r.close()
+        try:
+            # retries are done by downloader retry policy
+            if json_data is None:
+                r = self.downloader.get(meta['url'], headers=headers, auth=auth)
+            else:
+                r = self.downloader.post(meta['url'], json_data, headers=headers, auth=auth)
+        except requests.exceptions.RequestException as e:
+            self.logger.error(e)
         if r:
             meta['html'] = r.text
+            meta['headers'] = r.headers
         else:
             meta['error'] = "download failed: {}".format(meta['url'])
             self.logger.error("download failed: {}".format(meta['url']))
@@ -138,6 +154,36 @@ class RepositoryParser:
         if callback:
             return callback(meta)
 
+    def claim_url(self, url):
+        """
+        Record url as parsed.
+
+        :returns: False if url was already parsed
+        """
+        with self.parsed_lock:
+            if url in self.parsed:
+                return False
+            self.parsed.add(url)
+            return True
+
+    def download_all(self, metas):
+        """
+        Download urls of metas concurrently.
+
+        All engine steps share one pool of REQUESTS_WORKERS threads, and the
+        downloader limits requests in flight over all parsers.
+        """
+        if len(metas) <= 1:
+            for meta in metas:
+                self.download(meta)
+            return
+        executor = self.download_executor
+        if not executor:
+            with ThreadPoolExecutor(max_workers=min(len(metas), self.setting['REQUESTS_WORKERS'])) as executor:
+                list(executor.map(self.download, metas))
+            return
+        list(executor.map(self.download, metas))
+
     def parse(self, repositories_sources=None, database='', status_path=''):
         """
         common parse function
@@ -154,54 +200,165 @@ class RepositoryParser:
                 return
 
         self.failed_list = {}
+        with self.parsed_lock:
+            self.parsed = set()
         self.sources = repositories_sources
+        self.watermarks = store.get_watermarks(database) if database and self.setting['PARSE_INCREMENTAL'] else {}
+        self.new_watermarks = {}
+        requests_start, opened_start = self.downloader.get_stats()
 
-        repository_list = []
-        for repositories_source in repositories_sources:
-            meta_source = Meta()
-            meta_source['source'] = repositories_source['source']
-            meta_source['excludes'] = repositories_source['excludes']
-            meta_source['target_url'] = ','.join(repositories_source['targets'])
-
-            self.get_source_type(meta_source, self.process_error)
-            if meta_source['error']:
-                continue
-            if meta_source['source_type'] == 'index':
-                for meta_repository in self.parse_index(meta_source, self.process_error):
-                    if meta_repository['error']:
-                        continue
-                    if database:
-                        ret = store.add_repository(database, meta_repository['repository'])
-                        if isinstance(ret, int):
-                            yield meta_repository.to_dict()
-                        else:
-                            meta_repository['error'] = json.dumps(ret) if isinstance(ret, dict) else ret
-                            self.process_error(meta_source)
-                    else:
-                        yield meta_repository.to_dict()
-            else:
-                repository_list.append(meta_source)
-
-        for repository in repository_list:
-            meta_repository = self.parse_repository(repository)
-            if meta_repository['error']:
-                continue
-            if database:
-                ret = store.add_repository(database, meta_repository['repository'])
+        meta_repositories = self.parse_sources(repositories_sources, flush=bool(database))
+        if database:
+            # results come back in input order, once per batch or when parser is idle
+            pending = deque()
+            write_failed = set()
+            for ret in store.add_repositories(database, self.queue_repositories(meta_repositories, pending)):
+                meta_repository = pending.popleft()
                 if isinstance(ret, int):
                     yield meta_repository.to_dict()
                 else:
+                    if isinstance(ret, str):
+                        write_failed.add(meta_repository['source'])
                     meta_repository['error'] = json.dumps(ret) if isinstance(ret, dict) else ret
                     self.process_error(meta_repository)
-            else:
+            # only after repositories are stored, an interrupted parse scans again
+            for key, (watermark, last_full_scan) in self.new_watermarks.items():
+                if key.split(':', 1)[1] in write_failed:
+                    # repositories not stored are below the watermark
+                    continue
+                store.update_watermark(database, key, watermark, last_full_scan)
+        else:
+            for meta_repository in meta_repositories:
                 yield meta_repository.to_dict()
 
+        requests_end, opened_end = self.downloader.get_stats()
+        requests_count = requests_end - requests_start
+        opened = opened_end - opened_start
+        self.logger.info("http requests: {}, connections opened: {}, reused: {}".format(
+            requests_count, opened, max(0, requests_count - opened)))
+
         if status_path:
             name = ''
             if database:
                 name = os.path.basename(database).split('.')[0]
             self.save_status(status_path, name)
 
+    def parse_sources(self, repositories_sources, flush=False):
+        """
+        Parse all sources at once.
+
+        Sources are parsed by an asyncio engine on a background event loop,
+        repositories are yielded as soon as they are parsed, repositories of
+        different sources are interleaved.
+
+        :param repositories_sources: sources from configuration
+        :param flush: yield None when no repository is ready, consumer may flush what it holds
+        :yield: parsed repository meta without error
+        """
+        meta_sources = []
+        for repositories_source in repositories_sources:
+            meta_source = Meta()
+            meta_source['source'] = repositories_source['source']
+            meta_source['excludes'] = repositories_source['excludes']
+            meta_source['target_url'] = ','.join(repositories_source['targets'])
+            meta_source['clone_url_template'] = repositories_source.get('clone_url_template', '')
+            meta_sources.append(meta_source)
+        if not meta_sources:
+            return
+
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        self.executor = ThreadPoolExecutor(max_workers=self.setting['PARSE_CONCURRENCY'])
+        self.download_executor = ThreadPoolExecutor(max_workers=self.setting['REQUESTS_WORKERS'])
+        self.results = results = Queue()
+        self.stopped.clear()
+        future = asyncio.run_coroutine_threadsafe(self.parse_sources_async(meta_sources), loop)
+        # None marks the end of results
+        future.add_done_callback(lambda _: results.put(None))
+        try:
+            while True:
+                try:
+                    meta_repository = results.get_nowait()
+                except Empty:
+                    if flush:
+                        yield None
+                    meta_repository = results.get()
+                if meta_repository is None:
+                    break
+                yield meta_repository
+            future.result()
+        finally:
+            # consumer may leave early, steps not started yet are dropped
+            self.stopped.set()
+            asyncio.run_coroutine_threadsafe(self.cancel_tasks(), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+            self.download_executor.shutdown(wait=True, cancel_futures=True)
+            self.download_executor = None
+
+    async def cancel_tasks(self):
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def run_step(self, step, *args):
+        """
+        Run a blocking parser step in the engine thread pool.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, step, *args)
+
+    def emit_step(self, step, *args):
+        """
+        Run a blocking parser step and hand over its results to parse_sources.
+
+        :param step: returns a repository meta or an iterable of them
+        """
+        result = step(*args)
+        for meta_repository in [result] if isinstance(result, Meta) else result:
+            if self.stopped.is_set():
+                break
+            if not meta_repository['error']:
+                self.results.put(meta_repository)
+
+    async def parse_sources_async(self, meta_sources):
+        await self.get_source_types_async(meta_sources)
+        index_sources = [meta_source for meta_source in meta_sources
+                         if not meta_source['error'] and meta_source['source_type'] == 'index']
+        repository_sources = [meta_source for meta_source in meta_sources
+                              if not meta_source['error'] and meta_source['source_type'] != 'index']
+        # repository sources are parsed together, parsers may batch them
+        await asyncio.gather(*[self.parse_index_async(meta_source, self.process_error)
+                               for meta_source in index_sources],
+                             self.parse_repositories_async(repository_sources))
+
+    async def get_source_types_async(self, meta_sources):
+        await asyncio.gather(*[self.run_step(self.get_source_type, meta_source, self.process_error)
+                               for meta_source in meta_sources])
+
+    async def parse_repositories_async(self, meta_sources):
+        """
+        :param meta_sources: sources of repository type
+        """
+        await asyncio.gather(*[self.run_step(self.emit_step, self.parse_repository, meta_source)
+                               for meta_source in meta_sources])
+
+    async def parse_index_async(self, meta_source: Meta, error_callback=None):
+        await self.run_step(self.emit_step, self.parse_index, meta_source, error_callback)
+
+    def queue_repositories(self, meta_repositories, pending: deque):
+        for meta_repository in meta_repositories:
+            if meta_repository is None:
+                # parser idle, store the batch held so far
+                yield None
+                continue
+            pending.append(meta_repository)
+            yield meta_repository['repository']
+
     def get_source_type(self, meta_source: Meta, error_callback=None):
         raise NotImplementedError('Need to implemented in subclass')
 
@@ -215,9 +372,11 @@ class RepositoryParser:
         raise NotImplementedError('Need to implemented in subclass')
 
     def process_error(self, meta: Meta):
-        if meta['source'] not in self.failed_list:
-            self.failed_list[meta['source']] = []
-        self.failed_list[meta['source']].append(meta.to_dict())
+        # called from engine threads
+        with self.failed_lock:
+            if meta['source'] not in self.failed_list:
+                self.failed_list[meta['source']] = []
+            self.failed_list[meta['source']].append(meta.to_dict())
 
     def save_status(self, path='', name=''):
         """
@@ -252,7 +411,7 @@ class Cgit(RepositoryParser):
         self.download(meta_source)
         if meta_source['error']:
             return meta_source
-        soup = BeautifulSoup(meta_source['html'], 'html.parser')
+        soup = self.get_soup(meta_source['html'], SoupStrainer('table', attrs={'class': 'tabs'}))
         # Check if this is a index page
         tab = soup.find('table', attrs={'class': 'tabs'})
         if not tab:
@@ -270,6 +429,23 @@ class Cgit(RepositoryParser):
     def matches_excludes(self, meta: Meta):
         return meta['url'] in meta['excludes']
 
+    def get_soup(self, html, parse_only=None):
+        """
+        Build tree of the parts needed only, with lxml if available.
+
+        :param parse_only: SoupStrainer of needed tags
+        """
+        return BeautifulSoup(html, HTML_PARSER, parse_only=parse_only)
+
+    def get_index_soup(self, html):
+        """
+        Build tree of index page, tables and pager only with lxml.
+
+        Index pages are almost entirely the repository list, the strainer makes
+        html.parser slower on them.
+        """
+        return self.get_soup(html, SoupStrainer(['table', 'ul']) if HTML_PARSER == 'lxml' else None)
+
     def parse_index(self, meta_source: Meta, error_callback=None):
         """
             Parser Index page.
@@ -278,78 +454,215 @@ class Cgit(RepositoryParser):
             :param error_callback: error_callback function
             :yield: parse_repository
         """
+        for meta_repository in self.parse_index_rows(meta_source, error_callback):
+            yield self.parse_index_repository(meta_repository)
+
+    async def parse_index_async(self, meta_source: Meta, error_callback=None):
+        # summary pages of rows are fetched while index pages are walked
+        rows = self.parse_index_rows(meta_source, error_callback)
+        steps = []
+        while not self.stopped.is_set():
+            row = await self.run_step(next, rows, None)
+            if row is None:
+                break
+            steps.append(asyncio.ensure_future(self.run_step(self.emit_step, self.parse_index_repository, row)))
+        await asyncio.gather(*steps)
+
+    def parse_index_repository(self, meta_repository: Meta, error_callback=None):
+        """
+            Parser repository of index row, from clone url template of source if any.
+
+            Summary page is only fetched when the source has no template or
+            the clone url from template can't be validated.
+
+            :param meta_repository: repository meta from index row
+            :param error_callback: error process callback
+            :returns: repository
+        """
+        if not error_callback:
+            error_callback = self.process_error
+        clone_url = self.get_template_clone_url(meta_repository)
+        if not clone_url:
+            return self.parse_repository(meta_repository, error_callback)
+        if self.matches_excludes(meta_repository):
+            meta_repository['error'] = 'exclude'
+            error_callback(meta_repository)
+            return meta_repository
+        if not self.validate_clone_url(clone_url):
+            self.logger.debug("clone url {} not valid, parse summary page".format(clone_url))
+            return self.parse_repository(meta_repository, error_callback)
+        self.claim_url(meta_repository['url'])
+        section = meta_repository['section']
+        meta_repository['section'] = self.setting['DEFAULT_SECTION_NAME'] if not section and \
+            self.setting['ENABLE_DEFAULT_SECTION'] else section
+        meta_repository['clone_url'] = clone_url
+        return meta_repository
+
+    def get_template_clone_url(self, meta_repository: Meta):
+        """
+        Build clone url from template of source.
+
+        Template fields are {path}, the repository path in cgit from index link,
+        and {name}, the name column of index, e.g. https://git.yoctoproject.org/git/{path}
+
+        :returns: clone url, empty if source has no template
+        """
+        template = meta_repository['clone_url_template']
+        url = meta_repository['url']
+        if not template or not url:
+            return ''
+        source = meta_repository['source']
+        path = url[len(source):] if url.startswith(source) else urlparse(url).path
+        try:
+            return template.format(path=path.strip('/'), name=meta_repository['name'])
+        except (KeyError, IndexError, ValueError):
+            self.logger.error("clone url template error: {}".format(template))
+            return ''
+
+    def validate_clone_url(self, clone_url):
+        """
+        Probe clone url, http refs advertisement with a HEAD request or ``git ls-remote`` for others.
+        """
+        if clone_url.startswith(("http://", "https://")):
+            try:
+                page = self.downloader.head(clone_url.rstrip('/') + "/info/refs?service=git-upload-pack")
+            except requests.exceptions.RequestException:
+                return False
+            return page.status_code == 200
+        try:
+            ret = subprocess.run(["git", "ls-remote", clone_url, "HEAD"], stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.DEVNULL, timeout=self.setting['GIT_LOW_TIMEOUT'])
+        except (OSError, subprocess.TimeoutExpired):
+            return False
+        return ret.returncode == 0
+
+    def parse_index_rows(self, meta_source: Meta, error_callback=None):
+        """
+            Parser Index page rows.
+
+            :param meta_source: include necessary for build repository list
+            :param error_callback: error_callback function
+            :yield: repository meta from index row, summary page not parsed yet
+        """
         if not error_callback:
             error_callback = self.process_error
         original_url = meta_source['url']
         offset = 0
         if '?ofs=' in meta_source['url']:
             original_url = meta_source['url'].split("?ofs=")[0]
-            offset = meta_source['url'].split("?ofs=")[1]
+            offset = int(meta_source['url'].split("?ofs=")[1])
         original_offset = offset
-        while True:
-            meta_index = meta_source.partial_copy()
-            meta_index['url'] = original_url + "?ofs=" + str(offset)
-            if meta_index['url'] in self.parsed:
-                meta_index['error'] = "already parsed {}".format(meta_index['source'])
-                error_callback(meta_index)
-                break
-            if self.matches_excludes(meta_index):
-                meta_index['error'] = 'exclude'
-                error_callback(meta_index)
-                break
-            self.download(meta_index)
-            if meta_index['error']:
-                error_callback(meta_index)
-                break
-            soup = BeautifulSoup(meta_index['html'], 'html.parser')
-            table_list = soup.find('table', attrs={'class': 'list nowrap'})
-            offset_page = len(table_list.find_all('tr')) - \
-                     len(table_list.find_all('tr', attrs={'class': ['nohover', 'nohover-highlight']}))
-            self.parsed.append(meta_index['url'])
-            if offset_page == 0:
-                if offset == original_offset:
-                    meta_index['error'] = "empty index"
+        page_size = 0
+        # first page alone, then all pages from pager at once, then one by one until an empty page
+        offsets = [offset]
+        from_pager = False
+        while offsets and not self.stopped.is_set():
+            meta_pages = []
+            for page_offset in offsets:
+                meta_index = meta_source.partial_copy()
+                meta_index['url'] = original_url + "?ofs=" + str(page_offset)
+                meta_pages.append((page_offset, meta_index))
+                if not self.claim_url(meta_index['url']):
+                    meta_index['error'] = "already parsed {}".format(meta_index['source'])
+                    break
+                if self.matches_excludes(meta_index):
+                    meta_index['error'] = 'exclude'
+                    break
+            self.download_all([meta_index for _, meta_index in meta_pages if not meta_index['error']])
+            offset_page = 0
+            pager_offsets = []
+            for page_offset, meta_index in meta_pages:
+                if meta_index['error']:
                     error_callback(meta_index)
-                break
-            offset += offset_page
-            # process index page
-            table = soup.find('table', attrs={'class': 'list nowrap'})
-            if not table:
-                meta_index['error'] = "parsing failed"
-                error_callback(meta_index)
+                    return
+                soup = self.get_index_soup(meta_index['html'])
+                table = soup.find('table', attrs={'class': 'list nowrap'})
+                if not table:
+                    meta_index['error'] = "parsing failed"
+                    error_callback(meta_index)
+                    return
+                meta_repositories, offset_page = self.parse_index_table(meta_index, table)
+                if offset_page == 0:
+                    if page_offset == original_offset:
+                        meta_index['error'] = "empty index"
+                        error_callback(meta_index)
+                    return
+                offset = page_offset + offset_page
+                if page_offset == original_offset:
+                    page_size = offset_page
+                    pager_offsets = self.get_pager_offsets(soup, offset)
+                for meta_repository in meta_repositories:
+                    yield meta_repository
+            if pager_offsets:
+                offsets = pager_offsets
+                from_pager = True
+            elif from_pager and offset_page < page_size:
+                # last page of pager is not full
+                offsets = []
+            else:
+                offsets = [offset]
+
+    def get_pager_offsets(self, soup, offset):
+        """
+        :param offset: offset of the page following the first one
+        :returns: offsets of remaining pages from index footer, in order
+        """
+        pager = soup.find('ul', attrs={'class': 'pager'})
+        if not pager:
+            return []
+        offsets = set()
+        for link in pager.find_all('a', href=True):
+            match = re.search(r'[?&]ofs=(\d+)', link['href'])
+            if match and int(match.group(1)) >= offset:
+                offsets.add(int(match.group(1)))
+        return sorted(offsets)
+
+    def parse_index_table(self, meta_index: Meta, table):
+        """
+            Parser repository list table of index page in one walk.
+
+            :param meta_index: index page
+            :param table: repository list table
+            :returns: (repository metas, count of repository rows for next offset)
+        """
+        meta_repositories = []
+        offset_page = 0
+        section = ""
+        name_index = description_index = owner_index = -1
+        for row in table.find_all('tr'):
+            if not set(row.get('class', [])) & {'nohover', 'nohover-highlight'}:
+                offset_page += 1
+            cells = row.find_all(['td', 'th'], recursive=False)
+            cols = [cell for cell in cells if cell.name == 'td']
+            # Table header part
+            if len(cols) == 0:
+                for idx, th in enumerate(cells):
+                    th = th.text.strip()
+                    if th == "Name":
+                        name_index = idx
+                    elif th == "Description":
+                        description_index = idx
+                    elif th == "Owner":
+                        owner_index = idx
                 continue
-            section = ""
-            for row in table.find_all('tr'):
-                meta_repository = meta_index.partial_copy()
-                cols = row.find_all('td')
-                # Table header part
-                if len(cols) == 0:
-                    ths = row.find_all('th')
-                    for idx, th in enumerate(ths):
-                        th = th.text.strip()
-                        if th == "Name":
-                            name_index = idx
-                        elif th == "Description":
-                            description_index = idx
-                        elif th == "Owner":
-                            owner_index = idx
-                    continue
-                # section part
-                if len(cols) == 1:
-                    section = cols[0].text.strip()
-                    continue
-                # repo part
-                url = ""
+            # section part
+            if len(cols) == 1:
+                section = cols[0].text.strip()
+                continue
+            # repo part
+            meta_repository = meta_index.partial_copy()
+            url = ""
+            if name_index != -1:
                 for link in cols[name_index].find_all('a', href=True):
                     url = urljoin(meta_repository['source'], link['href'])
-                cols = [ele.text.strip() for ele in cols]
-                meta_repository['section'] = section
-                meta_repository['name'] = cols[name_index] if name_index != -1 else ""
-                meta_repository['descriptions'] = cols[description_index] if description_index != -1 else ""
-                meta_repository['owner'] = cols[owner_index] if owner_index != -1 else ""
-                meta_repository['url'] = url if url else ""
-
-                yield self.parse_repository(meta_repository)
+            cols = [ele.text.strip() for ele in cols]
+            meta_repository['section'] = section
+            meta_repository['name'] = cols[name_index] if name_index != -1 else ""
+            meta_repository['descriptions'] = cols[description_index] if description_index != -1 else ""
+            meta_repository['owner'] = cols[owner_index] if owner_index != -1 else ""
+            meta_repository['url'] = url if url else ""
+            meta_repositories.append(meta_repository)
+        return meta_repositories, offset_page
 
     def parse_repository(self, meta_repository: Meta, error_callback=None):
         """
@@ -369,8 +682,8 @@ class Cgit(RepositoryParser):
         if meta_repository['error']:
             error_callback(meta_repository)
             return meta_repository
-        self.parsed.append(meta_repository['url'])
-        soup = BeautifulSoup(meta_repository['html'], 'html.parser')
+        self.claim_url(meta_repository['url'])
+        soup = self.get_soup(meta_repository['html'], SoupStrainer('table'))
         # Process repo page
         # Check name, description and owner
         table = soup.find('table', attrs={'id': "header"})
@@ -425,6 +738,7 @@ class Cgit(RepositoryParser):
 
 
 class GitHub(RepositoryParser):
+    GRAPHQL_URL = "https://api.github.com/graphql"
 
     def get_source_type(self, meta_source: Meta, error_callback=None):
         if not error_callback:
@@ -451,48 +765,147 @@ class GitHub(RepositoryParser):
                     return True
         return False
 
+    def get_page_count(self, meta_index: Meta, per_page: int):
+        """
+        Read page count from response headers of first index page.
+
+        :param meta_index: first index page
+        :param per_page: repositories per page, to count pages from total_count
+        :returns: page count, 0 if unknown
+        """
+        headers = meta_index['headers']
+        for name in ('total_page', 'X-Total-Page'):
+            if headers.get(name, '').isdigit():
+                return int(headers[name])
+        if headers.get('total_count', '').isdigit():
+            return -(-int(headers['total_count']) // per_page)
+        match = re.search(r'[?&]page=(\d+)[^>]*>;\s*rel="last"', headers.get('Link', ''))
+        return int(match.group(1)) if match else 0
+
+    def download_index_pages(self, meta_source: Meta, url_template: str, per_page: int, error_callback,
+                             serial=False):
+        """
+        Download index pages.
+
+        Page count comes from headers of first page and remaining pages are downloaded
+        concurrently, without page count pages are downloaded one by one until an empty page.
+
+        :param url_template: index url with {} for page number
+        :param serial: download one by one, consumer may stop before last page
+        :yield: (meta_index, res_json) of each page in order
+        """
+        page = 1
+        page_count = 0
+        while not self.stopped.is_set():
+            numbers = range(page, page_count + 1) if page_count and not serial else [page]
+            meta_pages = []
+            for number in numbers:
+                meta_index = meta_source.partial_copy()
+                meta_index['url'] = url_template.format(number)
+                meta_pages.append(meta_index)
+                if not self.claim_url(meta_index['url']):
+                    meta_index['error'] = "already parsed {}".format(meta_index['source'])
+                    break
+            self.download_all([meta_index for meta_index in meta_pages if not meta_index['error']])
+            for meta_index in meta_pages:
+                if meta_index['error']:
+                    error_callback(meta_index)
+                    return
+                res_json = json.loads(meta_index['html'])
+                if not res_json:
+                    if page == 1:
+                        meta_index['error'] = "empty index"
+                        error_callback(meta_index)
+                    return
+                if page == 1:
+                    page_count = self.get_page_count(meta_index, per_page)
+                page += 1
+                yield meta_index, res_json
+            if page_count and page > page_count:
+                return
+
+    def get_watermark_key(self, meta_source: Meta):
+        return "{}:{}".format(self.__class__.__name__.lower(), meta_source['source'])
+
+    def get_scan_watermark(self, meta_source: Meta):
+        """
+        :returns: watermark to stop index at, empty for a full scan
+        """
+        watermark, last_full_scan = self.watermarks.get(self.get_watermark_key(meta_source), ('', 0))
+        if not watermark or not last_full_scan or \
+                time.time() - last_full_scan >= self.setting['PARSE_FULL_SCAN_INTERVAL']:
+            return ''
+        return watermark
+
+    def save_watermark(self, meta_source: Meta, watermark: str, full_scan: bool):
+        key = self.get_watermark_key(meta_source)
+        old_watermark, last_full_scan = self.watermarks.get(key, ('', 0))
+        if full_scan:
+            last_full_scan = int(time.time())
+        with self.failed_lock:
+            self.new_watermarks[key] = (max(watermark, old_watermark or ''), last_full_scan)
+
+    def download_index_repos(self, meta_source: Meta, url_template: str, per_page: int, error_callback,
+                             sortable=True):
+        """
+        Download repositories of index pages.
+
+        In incremental mode pages are sorted by updated time, and only repositories
+        updated since the watermark of last parse are yielded until next full scan.
+
+        :param url_template: index url with {} for page number
+        :param sortable: index api supports sort by updated time
+        :yield: (meta_index, repo) in order
+        """
+        incremental = self.setting['PARSE_INCREMENTAL'] and sortable
+        watermark = self.get_scan_watermark(meta_source) if incremental else ''
+        if incremental:
+            url_template += "&sort=updated&direction=desc"
+        failed = []
+
+        def index_error(meta_index):
+            failed.append(meta_index)
+            error_callback(meta_index)
+
+        latest = ''
+        pages = self.download_index_pages(meta_source, url_template, per_page, index_error, serial=bool(watermark))
+        for meta_index, res_json in pages:
+            for repo in res_json:
+                updated_at = repo.get('updated_at') or ''
+                if watermark and updated_at and updated_at < watermark:
+                    # older repositories are not changed since last parse
+                    pages.close()
+                    break
+                latest = max(latest, updated_at)
+                yield meta_index, repo
+        if incremental and not failed:
+            if watermark:
+                self.logger.debug("incremental parse of {} since {}".format(meta_source['source'], watermark))
+            self.save_watermark(meta_source, latest, full_scan=not watermark)
+
     def parse_index(self, meta_source: Meta, error_callback=None):
         if not error_callback:
             error_callback = self.process_error
         parsed_src = meta_source['source'].split("/")
         original_url = "https://api.github.com/users/{}/repos".format(parsed_src[0])
-        page = 1
-
-        while True:
-            meta_index = meta_source.partial_copy()
-            meta_index['url'] = original_url + "?page=" + str(page)
-            if meta_index['url'] in self.parsed:
-                meta_index['error'] = "already parsed {}".format(meta_index['source'])
-                error_callback(meta_index)
-                break
-            self.download(meta_index)
-            if meta_index['error']:
-                error_callback(meta_index)
-                break
-            res_json = json.loads(meta_index['html'])
-            if not res_json:
-                if page == 1:
-                    meta_index['error'] = "empty index"
-                    error_callback(meta_index)
-                break
-            page += 1
-            for repo in res_json:
-                meta_repository = meta_index.partial_copy()
-                if not repo['clone_url']:
-                    meta_repository['error'] = "No clone URL"
-                    error_callback(meta_repository)
-                    continue
-                meta_repository['name'] = repo['name']
-                meta_repository['section'] = repo['owner']['login']
-                meta_repository['owner'] = repo['owner']['login']
-                meta_repository['descriptions'] = repo['description']
-                meta_repository['html_url'] = repo['html_url']
-                meta_repository['clone_url'] = repo['clone_url']
-                if self.matches_excludes(meta_repository):
-                    meta_repository['error'] = "exclude"
-                    error_callback(meta_repository)
-                    continue
-                yield meta_repository
+        url_template = original_url + "?page={}"
+        for meta_index, repo in self.download_index_repos(meta_source, url_template, 30, error_callback):
+            meta_repository = meta_index.partial_copy()
+            if not repo['clone_url']:
+                meta_repository['error'] = "No clone URL"
+                error_callback(meta_repository)
+                continue
+            meta_repository['name'] = repo['name']
+            meta_repository['section'] = repo['owner']['login']
+            meta_repository['owner'] = repo['owner']['login']
+            meta_repository['descriptions'] = repo['description']
+            meta_repository['html_url'] = repo['html_url']
+            meta_repository['clone_url'] = repo['clone_url']
+            if self.matches_excludes(meta_repository):
+                meta_repository['error'] = "exclude"
+                error_callback(meta_repository)
+                continue
+            yield meta_repository
 
     def parse_repository(self, meta_source: Meta, error_callback=None):
         """
@@ -538,7 +951,80 @@ class GitHub(RepositoryParser):
             return meta_repository
         return meta_repository
 
+    async def parse_repositories_async(self, meta_sources):
+        batch_size = self.setting['GITHUB_GRAPHQL_BATCH_SIZE']
+        if not self.setting['GITHUB_GRAPHQL_ENABLED'] or not meta_sources or batch_size < 1:
+            return await super().parse_repositories_async(meta_sources)
+        # graphql api is only available with token
+        if not self.downloader.get_tokens('github'):
+            self.logger.warning("graphql needs github token, parse repositories one by one")
+            return await super().parse_repositories_async(meta_sources)
+        batches = [meta_sources[i:i + batch_size] for i in range(0, len(meta_sources), batch_size)]
+        await asyncio.gather(*[self.run_step(self.emit_step, self.parse_repositories_graphql, batch)
+                               for batch in batches])
+
+    def parse_repositories_graphql(self, meta_sources, error_callback=None):
+        """
+            Parser repositories with one graphql query, fall back to parse_repository if query failed.
+
+            :param meta_sources: sources of repository type
+            :param error_callback: error process callback
+            :returns: repositories in order of sources
+        """
+        if not error_callback:
+            error_callback = self.process_error
+        meta_repositories = []
+        fields = []
+        for index, meta_source in enumerate(meta_sources):
+            parsed_src = meta_source['source'].split("/")
+            meta_repository = meta_source.partial_copy()
+            meta_repository['url'] = "https://api.github.com/repos/{}/{}".format(parsed_src[0], parsed_src[1])
+            meta_repositories.append(meta_repository)
+            if self.matches_excludes(meta_repository):
+                meta_repository['error'] = 'exclude'
+                continue
+            # json string is a valid graphql string literal
+            fields.append("r{}: repository(owner: {}, name: {}) {{ name owner {{ login }} description url }}".format(
+                index, json.dumps(parsed_src[0]), json.dumps(parsed_src[1])))
+        if not fields:
+            return meta_repositories
+        meta_query = Meta()
+        meta_query['url'] = self.GRAPHQL_URL
+        self.download(meta_query, json_data={'query': "query {{ {} }}".format(' '.join(fields))})
+        data = None
+        if not meta_query['error']:
+            try:
+                data = json.loads(meta_query['html']).get('data')
+            except ValueError:
+                data = None
+        if not data:
+            self.logger.warning("graphql query failed, parse {} repositories one by one".format(len(meta_sources)))
+            return [self.parse_repository(meta_source, error_callback) for meta_source in meta_sources]
+
+        for index, meta_repository in enumerate(meta_repositories):
+            if meta_repository['error']:
+                continue
+            repo = data.get("r{}".format(index))
+            if not repo:
+                meta_repository['error'] = "Github cannot find this repository"
+                error_callback(meta_repository)
+                continue
+            meta_repository['name'] = repo['name']
+            meta_repository['section'] = repo['owner']['login']
+            meta_repository['owner'] = repo['owner']['login']
+            meta_repository['descriptions'] = repo['description']
+            meta_repository['html_url'] = repo['url']
+            meta_repository['clone_url'] = repo['url'] + ".git"
+            if self.matches_excludes(meta_repository):
+                meta_repository['error'] = "exclude"
+                error_callback(meta_repository)
+        return meta_repositories
+
+
 class Gitee(GitHub):
+    # gitee has no graphql api
+    parse_repositories_async = RepositoryParser.parse_repositories_async
+
     def parse_index(self, meta_source: Meta, error_callback=None):
         if not error_callback:
             error_callback = self.process_error
@@ -573,43 +1059,26 @@ class Gitee(GitHub):
         else:
             original_url = "https://gitee.com/api/v5/users/{}/repos".format(parsed_src[0])
         
-        page = 1
-
-        while True:
-            meta_index = meta_source.partial_copy()
-            meta_index['url'] = original_url + "?&type=all&page=" + str(page) + '&per_page=100'
-            if meta_index['url'] in self.parsed:
-                meta_index['error'] = "already parsed {}".format(meta_index['source'])
-                error_callback(meta_index)
-                break
-            self.download(meta_index)
-            if meta_index['error']:
-                error_callback(meta_index)
-                break
-            res_json = json.loads(meta_index['html'])
-            if not res_json:
-                if page == 1:
-                    meta_index['error'] = "empty index"
-                    error_callback(meta_index)
-                break
-            page += 1
-            for repo in res_json:
-                meta_repository = meta_index.partial_copy()
-                if not repo['html_url']:
-                    meta_repository['error'] = "No clone URL"
-                    error_callback(meta_repository)
-                    continue
-                meta_repository['name'] = repo['name']
-                meta_repository['section'] = repo['owner']['name'] if not sub_type else repo['namespace']['name']
-                meta_repository['owner'] = repo['owner']['name']
-                meta_repository['descriptions'] = repo['description']
-                meta_repository['html_url'] = repo['url']
-                meta_repository['clone_url'] = repo['html_url']
-                if self.matches_excludes(meta_repository):
-                    meta_repository['error'] = "exclude"
-                    error_callback(meta_repository)
-                    continue
-                yield meta_repository
+        url_template = original_url + "?&type=all&page={}&per_page=100"
+        # only user repositories api supports sort
+        for meta_index, repo in self.download_index_repos(meta_source, url_template, 100, error_callback,
+                                                          sortable=not sub_type):
+            meta_repository = meta_index.partial_copy()
+            if not repo['html_url']:
+                meta_repository['error'] = "No clone URL"
+                error_callback(meta_repository)
+                continue
+            meta_repository['name'] = repo['name']
+            meta_repository['section'] = repo['owner']['name'] if not sub_type else repo['namespace']['name']
+            meta_repository['owner'] = repo['owner']['name']
+            meta_repository['descriptions'] = repo['description']
+            meta_repository['html_url'] = repo['url']
+            meta_repository['clone_url'] = repo['html_url']
+            if self.matches_excludes(meta_repository):
+                meta_repository['error'] = "exclude"
+                error_callback(meta_repository)
+                continue
+            yield meta_repository
 
     def parse_repository(self, meta_source: Meta, error_callback=None):
         """
@@ -1,11 +1,57 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
 import sqlite3
-from os.path import exists, basename
+import atexit
+import threading
+from shutil import move
+from os.path import exists, basename, abspath
 import logging
 from .minisetting import Setting
 
+SCHEMA_VERSION = 3
+
+# (path, thread) -> (connection, inode), shared by all RepositoryStore
+_connections = {}
+_connections_lock = threading.Lock()
+# path -> clone_url has a unique index, upsert needs it
+_unique_clone_url = {}
+
+
+def close_connections(path=None, thread_ids=None):
+    """
+    Close cached database connections.
+
+    :param path: only close connections of this sqlite file, None for all
+    :param thread_ids: only close connections of these threads, None for all
+    """
+    path = abspath(path) if path else None
+    with _connections_lock:
+        for key in list(_connections):
+            if (path is None or key[0] == path) and (thread_ids is None or key[1] in thread_ids):
+                connection, inode = _connections.pop(key)
+                try:
+                    # refresh statistics of indexes used by this connection
+                    connection.execute("PRAGMA optimize")
+                except sqlite3.Error:
+                    pass
+                connection.close()
+
+
+def prune_connections():
+    """
+    Close connections cached by threads which ended.
+    """
+    alive = {thread.ident for thread in threading.enumerate()}
+    with _connections_lock:
+        ended = {key[1] for key in _connections if key[1] not in alive}
+    if ended:
+        close_connections(thread_ids=ended)
+
+
+atexit.register(close_connections)
+
 
 class Repository:
     def __init__(self):
@@ -90,45 +136,217 @@ class RepositoryStore:
         self.logger = logger or logging.getLogger(self.__class__.__name__)
         self.sqlite_file = ''
         self.sqlite_connection = None
+        self.opened = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for path in self.opened:
+            self.close(path)
+        self.opened = set()
 
     def open(self, path):
+        """
+        Get the cached connection of sqlite file, connect if not cached yet.
+
+        Connections are cached per sqlite file and thread, and reused until
+        close() or process exit, connections of ended threads are closed when
+        another connection is made. A file replaced on disk gets a new connection.
+        """
         if exists(path):
-            if self.sqlite_connection:
-                self.close()
+            key = (abspath(path), threading.get_ident())
+            inode = os.stat(path).st_ino
+            with _connections_lock:
+                connection, cached_inode = _connections.get(key, (None, None))
+            if connection and cached_inode == inode:
+                self.sqlite_file = path
+                self.sqlite_connection = connection
+                return connection
+            if connection:
+                # file replaced, other threads reconnect on their next open
+                close_connections(path, {key[1]})
+            # connections of ended threads would stay open until exit
+            prune_connections()
             try:
                 self.sqlite_file = path
-                self.sqlite_connection = sqlite3.connect(self.sqlite_file)
+                self.sqlite_connection = sqlite3.connect(self.sqlite_file, check_same_thread=False)
+                self.sqlite_connection.row_factory = sqlite3.Row
+                with _connections_lock:
+                    _connections[key] = (self.sqlite_connection, inode)
+                self.opened.add(key[0])
                 self.logger.debug("数据库连接<{}>已打开".format(basename(self.sqlite_file)))
+                self.configure()
+                self.upgrade()
             except sqlite3.Error as error:
                 self.logger.error("数据库出错啦: %s", error)
         else:
+            self.sqlite_connection = None
             self.logger.debug("数据库文件: %s 不存在", path)
+        return self.sqlite_connection
+
+    def close(self, path=None):
+        """
+        Close connection of sqlite file cached by calling thread, needed before
+        moving or removing it. Connections of other threads are left to them,
+        they reconnect when the file is replaced.
+
+        :param path: sqlite file, default the last opened one
+        """
+        path = path if path else self.sqlite_file
+        if path:
+            close_connections(path, {threading.get_ident()})
+            self.logger.debug("数据库连接<{}>已关闭".format(basename(path)))
+        self.sqlite_connection = None
 
-    def close(self):
-        if self.sqlite_connection:
-            self.sqlite_connection.close()
-            self.sqlite_connection = None
-            self.logger.debug("数据库连接<{}>已关闭".format(basename(self.sqlite_file)))
+    def checkpoint(self, sqlite_file):
+        """
+        Copy committed transactions of WAL journal into sqlite file and truncate it.
+        """
+        self.open(sqlite_file)
+        if not self.sqlite_connection:
+            return
+        try:
+            self.sqlite_connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except sqlite3.Error as error:
+            self.logger.error("数据库出错啦: %s", error)
+
+    def move_database(self, sqlite_file, dst_file):
+        """
+        Move sqlite file with its -wal and -shm files, checkpointed and closed first.
+        """
+        self.checkpoint(sqlite_file)
+        self.close(sqlite_file)
+        for suffix in ('-wal', '-shm', ''):
+            if exists(sqlite_file + suffix):
+                move(sqlite_file + suffix, dst_file + suffix)
+
+    def remove_database(self, sqlite_file):
+        """
+        Remove sqlite file with its -wal and -shm files.
+        """
+        self.close(sqlite_file)
+        for suffix in ('-wal', '-shm', ''):
+            if exists(sqlite_file + suffix):
+                os.remove(sqlite_file + suffix)
+
+    def configure(self):
+        """
+        Tune opened connection.
+
+        WAL journal lets readers run along with the writer, switching to it is
+        persistent and migrates an existing database in place.
+        """
+        try:
+            cursor = self.sqlite_connection.cursor()
+            if self.setting['DATABASE_WAL_ENABLED']:
+                cursor.execute("PRAGMA journal_mode=WAL")
+                cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.execute("PRAGMA cache_size=-{}".format(int(self.setting['DATABASE_CACHE_SIZE'])))
+            cursor.execute("PRAGMA mmap_size={}".format(int(self.setting['DATABASE_MMAP_SIZE'])))
+            cursor.close()
+        except sqlite3.Error as error:
+            self.logger.error("数据库出错啦: %s", error)
+
+    def add_column(self, cursor, table: str, column: str, definition: str):
+        cursor.execute("PRAGMA table_info({})".format(table))
+        if column not in [record[1] for record in cursor.fetchall()]:
+            cursor.execute("ALTER TABLE {} ADD COLUMN {} {}".format(table, column, definition))
+
+    def get_indexed_columns(self, cursor, table: str):
+        """
+        :returns: {column: unique} for columns leading an index of table
+        """
+        indexed = {}
+        cursor.execute("PRAGMA index_list({})".format(table))
+        for index in cursor.fetchall():
+            cursor.execute("PRAGMA index_info('{}')".format(index['name']))
+            columns = cursor.fetchall()
+            if columns:
+                column = columns[0]['name']
+                indexed[column] = indexed.get(column, False) or (bool(index['unique']) and len(columns) == 1)
+        return indexed
+
+    def add_indexes(self, cursor):
+        """
+        Make sure lookups by clone_url and source and ordering by last_update are indexed.
+        """
+        indexed = self.get_indexed_columns(cursor, 'Repositories')
+        unique = bool(indexed.get('clone_url'))
+        if not unique:
+            try:
+                # upsert on clone_url needs it unique
+                cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_repositories_clone_url "
+                               "ON Repositories(clone_url)")
+                unique = True
+            except sqlite3.IntegrityError as error:
+                self.logger.warning("clone_url重复, 无法建立唯一索引: %s", error)
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_repositories_clone_url_dup "
+                               "ON Repositories(clone_url)")
+        with _connections_lock:
+            _unique_clone_url[abspath(self.sqlite_file)] = unique
+        for column in ('source', 'last_update'):
+            if column not in indexed:
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_repositories_{0} ON Repositories({0})".format(column))
+        self.sqlite_connection.commit()
+
+    def upgrade(self):
+        """
+        Upgrade schema of opened database to SCHEMA_VERSION.
+
+        Databases are created from user sql templates, columns and indexes used
+        internally are added here whatever template created the database.
+        """
+        try:
+            cursor = self.sqlite_connection.cursor()
+            self.add_indexes(cursor)
+            cursor.execute("PRAGMA user_version")
+            version = cursor.fetchone()[0]
+            if version >= SCHEMA_VERSION:
+                cursor.close()
+                return
+            if version < 1:
+                self.add_column(cursor, 'Repositories', 'ref_fingerprint', 'TEXT')
+            if version < 2:
+                # high-water mark of index sources for incremental parse
+                cursor.execute("CREATE TABLE IF NOT EXISTS SourceWatermarks ("
+                               "source TEXT PRIMARY KEY NOT NULL, "
+                               "watermark TEXT, "
+                               "last_full_scan INTEGER)")
+            if version < 3:
+                # git maintenance schedule of mirrors
+                self.add_column(cursor, 'Repositories', 'last_maintenance', 'TEXT')
+                self.add_column(cursor, 'Repositories', 'fetch_count', 'INTEGER DEFAULT 0')
+            cursor.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
+            self.sqlite_connection.commit()
+            cursor.close()
+            self.logger.debug("数据库<{}>升级到版本{}".format(basename(self.sqlite_file), SCHEMA_VERSION))
+        except sqlite3.Error as error:
+            self.logger.error("数据库出错啦: %s", error)
 
     def create(self, sql_file, sqlite_file):
         if not exists(sql_file):
             raise ValueError("SQL文件: {} 不存在".format(sql_file))
         if exists(sqlite_file):
             raise ValueError("SQL文件: {} 已存在，使用<open>函数打开".format(basename(sqlite_file)))
+        connection = None
         try:
-            self.sqlite_file = sqlite_file
-            self.sqlite_connection = sqlite3.connect(sqlite_file)
+            connection = sqlite3.connect(sqlite_file)
             with open(sql_file, 'r') as f:
                 sql_script = f.read()
-            cursor = self.sqlite_connection.cursor()
+            cursor = connection.cursor()
             cursor.executescript(sql_script)
             cursor.close()
+            connection.commit()
             self.logger.debug("数据库<{}>创建成功".format(basename(sqlite_file)))
         except sqlite3.Error as error:
             self.logger.error("数据库出错啦: %s", error)
             raise DatabaseError("{}".format(error))
         finally:
-            self.close()
+            if connection:
+                connection.close()
+        # upgrade schema and keep the connection for following calls
+        self.open(sqlite_file)
 
     def add_repository(self, sqlite_file, repository: Repository):
         self.open(sqlite_file)
@@ -148,9 +366,8 @@ class RepositoryStore:
             if "UNIQUE constraint failed" in str(error):
                 duplicate = self.find_duplicate(sqlite_file, repository)
                 duplicate_id = duplicate['id']
-                del duplicate['id']
-                del duplicate['last_update']
-                del duplicate['last_check']
+                # only compare parsed fields, skip database managed columns
+                duplicate = {name: duplicate[name] for name in repository}
                 if duplicate['source_type'] == 'repository' and repository['source_type'] == 'index':
                     self.merge_duplicate(sqlite_file, duplicate_id, repository)
                     ret = {'merger': duplicate}
@@ -163,9 +380,96 @@ class RepositoryStore:
                 ret = 'write to database failed {}'.format(error)
                 self.logger.error("写入数据库出错啦: %s %s", repository['name'], error)
         finally:
-            self.close()
             return ret
 
+    def add_repositories(self, sqlite_file, repositories, batch_size=0):
+        """
+        Add repositories in batches, one transaction per batch.
+
+        Duplicates are resolved by upsert on clone_url, with same rules as add_repository.
+        Without unique index on clone_url, duplicates are resolved row by row in the transaction.
+
+        :param repositories: iterable of Repository, None stores the repositories held so far
+        :param batch_size: repositories per transaction, default DATABASE_BATCH_SIZE
+        :yield: add_repository result of each repository, in input order
+        """
+        batch_size = batch_size if batch_size else self.setting['DATABASE_BATCH_SIZE']
+        batch = []
+        for repository in repositories:
+            if repository is not None:
+                batch.append(repository)
+            if batch and (repository is None or len(batch) >= batch_size):
+                yield from self.add_repository_batch(sqlite_file, batch)
+                batch = []
+        if batch:
+            yield from self.add_repository_batch(sqlite_file, batch)
+
+    def add_repository_batch(self, sqlite_file, batch):
+        self.open(sqlite_file)
+        ret = []
+        fields = list(Repository())
+        with _connections_lock:
+            unique = _unique_clone_url.get(abspath(sqlite_file), True)
+        try:
+            self.logger.debug("add_repository_batch: {} repositories".format(len(batch)))
+            cursor = self.sqlite_connection.cursor()
+            # find duplicates of whole batch first, keep under sqlite host parameter limit
+            existing = {}
+            clone_urls = list({repository['clone_url'] for repository in batch})
+            for start in range(0, len(clone_urls), 500):
+                chunk = clone_urls[start:start + 500]
+                sqlite_select_query = "SELECT * FROM Repositories WHERE clone_url IN ({})".format(
+                    ','.join('?' * len(chunk)))
+                cursor.execute(sqlite_select_query, chunk)
+                for record in cursor.fetchall():
+                    existing[record['clone_url']] = dict(record)
+            # merge an index repository into a repository source, refresh check time of identical one,
+            # leave any other duplicate untouched
+            sqlite_upsert_query = "INSERT INTO Repositories({}, last_check) " \
+                                  "VALUES({}, datetime('now','localtime')) " \
+                                  "ON CONFLICT(clone_url) DO UPDATE SET {}, last_check=excluded.last_check " \
+                                  "WHERE (Repositories.source_type='repository' AND excluded.source_type='index') " \
+                                  "OR ({})".format(', '.join(fields),
+                                                   ','.join('?' * len(fields)),
+                                                   ', '.join('{0}=excluded.{0}'.format(f) for f in fields),
+                                                   ' AND '.join('Repositories.{0} IS excluded.{0}'.format(f)
+                                                                for f in fields))
+            sqlite_insert_query = "INSERT INTO Repositories({}, last_check) " \
+                                  "VALUES({}, datetime('now','localtime'))".format(', '.join(fields),
+                                                                                 ','.join('?' * len(fields)))
+            sqlite_update_query = "UPDATE Repositories SET {}, last_check=datetime('now','localtime') " \
+                                  "WHERE id=?".format(', '.join('{}=?'.format(f) for f in fields))
+            for repository in batch:
+                duplicate = existing.get(repository['clone_url'])
+                if unique:
+                    cursor.execute(sqlite_upsert_query, repository.to_tuple())
+                elif not duplicate:
+                    cursor.execute(sqlite_insert_query, repository.to_tuple())
+                if not duplicate:
+                    existing[repository['clone_url']] = dict(repository.to_dict(), id=cursor.lastrowid)
+                    ret.append(cursor.lastrowid)
+                    continue
+                duplicate_id = duplicate['id']
+                duplicate = {name: duplicate[name] for name in fields}
+                if duplicate['source_type'] == 'repository' and repository['source_type'] == 'index':
+                    if not unique:
+                        cursor.execute(sqlite_update_query, repository.to_tuple() + (duplicate_id,))
+                    existing[repository['clone_url']] = dict(repository.to_dict(), id=duplicate_id)
+                    ret.append({'merger': duplicate})
+                elif duplicate == repository.to_dict():
+                    if not unique:
+                        cursor.execute(sqlite_update_query, repository.to_tuple() + (duplicate_id,))
+                    ret.append(duplicate_id)
+                else:
+                    ret.append({'duplicate': duplicate})
+            self.sqlite_connection.commit()
+            cursor.close()
+        except sqlite3.Error as error:
+            self.sqlite_connection.rollback()
+            self.logger.error("写入数据库出错啦: %s", error)
+            ret = ['write to database failed {}'.format(error)] * len(batch)
+        return ret
+
     def merge_duplicate(self, sqlite_file, merge_repository_id, repository: Repository):
         self.open(sqlite_file)
         try:
@@ -179,8 +483,6 @@ class RepositoryStore:
             cursor.close()
         except sqlite3.Error as error:
             self.logger.error("数据库出错啦: %s", error)
-        finally:
-            self.close()
 
     def update_time(self, sqlite_file, name: str, repository_id: int):
         self.open(sqlite_file)
@@ -193,8 +495,65 @@ class RepositoryStore:
             cursor.close()
         except sqlite3.Error as error:
             self.logger.error("数据库出错啦: %s", error)
-        finally:
-            self.close()
+
+    def update_mirror_state(self, sqlite_file, repository_id: int, ref_fingerprint: str):
+        self.open(sqlite_file)
+        try:
+            self.logger.debug("update_mirror_state: {} {}".format(repository_id, ref_fingerprint))
+            cursor = self.sqlite_connection.cursor()
+            # fetches since last maintenance, refs unknown counts as fetched
+            sqlite_update_query = "UPDATE Repositories SET last_update=datetime('now','localtime'), " \
+                                  "fetch_count=IFNULL(fetch_count, 0) + " \
+                                  "(?='' OR ref_fingerprint IS NOT ?), " \
+                                  "ref_fingerprint=? WHERE id=?"
+            cursor.execute(sqlite_update_query, (ref_fingerprint, ref_fingerprint, ref_fingerprint,
+                                                 str(repository_id)))
+            self.sqlite_connection.commit()
+            cursor.close()
+        except sqlite3.Error as error:
+            self.logger.error("数据库出错啦: %s", error)
+
+    def update_maintenance(self, sqlite_file, repository_id: int):
+        self.open(sqlite_file)
+        try:
+            self.logger.debug("update_maintenance: {}".format(repository_id))
+            cursor = self.sqlite_connection.cursor()
+            sqlite_update_query = "UPDATE Repositories SET last_maintenance=datetime('now','localtime'), " \
+                                  "fetch_count=0 WHERE id=?"
+            cursor.execute(sqlite_update_query, (str(repository_id),))
+            self.sqlite_connection.commit()
+            cursor.close()
+        except sqlite3.Error as error:
+            self.logger.error("数据库出错啦: %s", error)
+
+    def get_watermarks(self, sqlite_file):
+        """
+        :returns: {source: (watermark, last_full_scan)}
+        """
+        self.open(sqlite_file)
+        ret = {}
+        try:
+            cursor = self.sqlite_connection.cursor()
+            cursor.execute("SELECT * FROM SourceWatermarks")
+            for record in cursor.fetchall():
+                ret[record['source']] = (record['watermark'], record['last_full_scan'])
+            cursor.close()
+        except sqlite3.Error as error:
+            self.logger.error("数据库出错啦: %s", error)
+        return ret
+
+    def update_watermark(self, sqlite_file, source: str, watermark: str, last_full_scan: int):
+        self.open(sqlite_file)
+        try:
+            self.logger.debug("update_watermark: {} {}".format(source, watermark))
+            cursor = self.sqlite_connection.cursor()
+            sqlite_update_query = "INSERT OR REPLACE INTO SourceWatermarks (source, watermark, last_full_scan) " \
+                                  "VALUES (?, ?, ?)"
+            cursor.execute(sqlite_update_query, (source, watermark, last_full_scan))
+            self.sqlite_connection.commit()
+            cursor.close()
+        except sqlite3.Error as error:
+            self.logger.error("数据库出错啦: %s", error)
 
     def update_check_time(self, sqlite_file, repository_id: int):
         self.update_time(sqlite_file, 'last_check', repository_id)
@@ -207,7 +566,6 @@ class RepositoryStore:
         ret = {}
         try:
             self.logger.debug("find_duplicate: {}".format(repository.to_dict()))
-            self.sqlite_connection.row_factory = sqlite3.Row
             cursor = self.sqlite_connection.cursor()
             sqlite_select_query = "SELECT * FROM Repositories WHERE clone_url=? "
             cursor.execute(sqlite_select_query, (repository['clone_url'],))
@@ -218,7 +576,6 @@ class RepositoryStore:
         except sqlite3.Error as error:
             self.logger.error("数据库出错啦: %s", error)
         finally:
-            self.close()
             return ret
 
     def get_repository_list_by_source(self, sqlite_file, source: str):
@@ -226,7 +583,6 @@ class RepositoryStore:
         ret = []
         try:
             self.logger.debug("get_repository_list_by_source: {}".format(source))
-            self.sqlite_connection.row_factory = sqlite3.Row
             cursor = self.sqlite_connection.cursor()
             sqlite_select_query = "SELECT * FROM Repositories WHERE source=? "
             cursor.execute(sqlite_select_query, (source,))
@@ -237,16 +593,17 @@ class RepositoryStore:
         except sqlite3.Error as error:
             self.logger.error("数据库出错啦: %s", error)
         finally:
-            self.close()
             return ret
 
-    def get_repository_list(self, sqlite_file):
+    def get_repository_list(self, sqlite_file, stale_first=False):
         self.open(sqlite_file)
         ret = []
         try:
-            self.sqlite_connection.row_factory = sqlite3.Row
             cursor = self.sqlite_connection.cursor()
             sqlite_select_query = "SELECT * FROM Repositories"
+            if stale_first:
+                # never mirrored first, then least recently updated
+                sqlite_select_query += " ORDER BY last_update IS NOT NULL, last_update"
             cursor.execute(sqlite_select_query)
             records = cursor.fetchall()
             if records:
@@ -255,12 +612,33 @@ class RepositoryStore:
         except sqlite3.Error as error:
             self.logger.error("数据库出错啦: %s", error)
         finally:
-            self.close()
             return ret
 
+    def iter_repository_list(self, sqlite_file, columns=(), batch_size=1000):
+        """
+        Same rows as get_repository_list, fetched in batches.
+
+        :param columns: columns to select, all if empty
+        :yield: repository dict
+        """
+        self.open(sqlite_file)
+        cursor = self.sqlite_connection.cursor()
+        try:
+            select = ', '.join(columns) if columns else '*'
+            cursor.execute("SELECT {} FROM Repositories".format(select))
+            while True:
+                records = cursor.fetchmany(batch_size)
+                if not records:
+                    break
+                for record in records:
+                    yield dict(record)
+        except sqlite3.Error as error:
+            self.logger.error("数据库出错啦: %s", error)
+        finally:
+            cursor.close()
+
     def get_sources_list(self):
         try:
-            self.sqlite_connection.row_factory = sqlite3.Row
             cursor = self.sqlite_connection.cursor()
             sqlite_select_query = "SELECT DISTINCT source, source_type FROM Repositories"
             cursor.execute(sqlite_select_query)
@@ -290,7 +668,6 @@ class RepositoryStore:
             self.logger.error("数据库出错啦: %s", error)
             raise DatabaseError("{}".format(error))
         finally:
-            self.close()
             return ret
 
     def get_repositories(self, sqlite_file: str):
@@ -317,8 +694,6 @@ class RepositoryStore:
         except sqlite3.Error as error:
             self.logger.error("数据库出错啦: %s", error)
             raise DatabaseError("{}".format(error))
-        finally:
-            self.close()
 
     def update_original_sql(self, sqlite_file: str, file_name: str):
         self.update_config(sqlite_file, 'original_sql', file_name)
@@ -327,7 +702,6 @@ class RepositoryStore:
         self.open(sqlite_file)
         ret = {}
         try:
-            self.sqlite_connection.row_factory = sqlite3.Row
             cursor = self.sqlite_connection.cursor()
             sqlite_select_query = "SELECT * FROM Configurations"
             cursor.execute(sqlite_select_query)
@@ -338,5 +712,4 @@ class RepositoryStore:
         except sqlite3.Error as error:
             self.logger.error("数据库出错啦: %s", error)
         finally:
-            self.close()
             return ret
@@ -14,17 +14,29 @@ def get_version(setting: Setting = None):
     return version
 
 
-def get_token(setting: Setting = None, token_type=''):
+def get_tokens(setting: Setting = None, token_type=''):
+    """
+    Read all tokens of token file, one user:token per line.
+
+    :returns: list of (user, token), lines not in user:token format are skipped
+    """
     if not token_type or token_type.upper() not in ['GITHUB', 'GITEE']:
-        return ()
+        return []
     setting = setting if setting else Setting()
     key = token_type.upper() + '_TOKEN'
+    tokens = []
     if exists(setting[key]):
-        token = ()
         with open(setting[key], "r", encoding='utf8') as token_f:
-            token = token_f.read().strip().split(':')
-        return (token[0], token[1]) if len(token) == 2 else ()
-    return ()
+            for line in token_f:
+                token = line.strip().split(':')
+                if len(token) == 2 and all(token):
+                    tokens.append((token[0], token[1]))
+    return tokens
+
+
+def get_token(setting: Setting = None, token_type=''):
+    tokens = get_tokens(setting, token_type)
+    return tokens[0] if tokens else ()
 
 
 def set_logger(setting: Setting, log_enable=True, log_level='DEBUG', log_file=None, log_dir=''):
@@ -35,9 +47,17 @@ def set_logger(setting: Setting, log_enable=True, log_level='DEBUG', log_file=No
         setting['LOG_DIR'] = log_dir
 
 
+# handlers added by config_logging, replaced on each call
+_handlers = []
+
+
 def config_logging(setting=None):
     setting = setting if setting else Setting()
     logger = logging.getLogger()
+    while _handlers:
+        handler = _handlers.pop()
+        logger.removeHandler(handler)
+        handler.close()
     logger.setLevel(setting['LOG_LEVEL'])
     formatter = logging.Formatter(setting['LOG_FORMAT'])
     if setting['LOG_FILE']:
@@ -47,7 +67,9 @@ def config_logging(setting=None):
     console.setFormatter(formatter)
     if setting['LOG_ENABLED']:
         if setting['LOG_FILE']:
-            logger.addHandler(log_file)
-        logger.addHandler(console)
+            _handlers.append(log_file)
+        _handlers.append(console)
     else:
-        logger.addHandler(logging.NullHandler())
+        _handlers.append(logging.NullHandler())
+    for handler in _handlers:
+        logger.addHandler(handler)
@@ -0,0 +1,69 @@
+import unittest
+from datetime import datetime
+import threading
+import sys
+sys.path.insert(0, '..')
+from repository.daemon import CronExpression, CronError, ServiceDaemon
+from repository.minisetting import Setting
+
+
+class  DaemonTest(unittest.TestCase):
+
+    def test_1_cron_parse(self):
+        cron = CronExpression('*/5 * * * *')
+        self.assertEqual(cron.minutes, set(range(0, 60, 5)))
+        cron = CronExpression('0,30 8-18/2 1 1-6 7')
+        self.assertEqual(cron.minutes, {0, 30})
+        self.assertEqual(cron.hours, {8, 10, 12, 14, 16, 18})
+        self.assertEqual(cron.weekdays, {0})
+        for expression in ['* * * *', '60 * * * *', '*/0 * * * *', 'a * * * *', '5-1 * * * *']:
+            with self.assertRaises(CronError):
+                CronExpression(expression)
+
+    def test_2_cron_next(self):
+        now = datetime(2020, 1, 1, 10, 3, 30)
+        self.assertEqual(CronExpression('*/5 * * * *').get_next(now), datetime(2020, 1, 1, 10, 5))
+        self.assertEqual(CronExpression('0 0 * * *').get_next(now), datetime(2020, 1, 2, 0, 0))
+        self.assertEqual(CronExpression('30 2 1 * *').get_next(now), datetime(2020, 2, 1, 2, 30))
+        # 2020-01-06 is a monday
+        self.assertEqual(CronExpression('0 9 * * 1').get_next(now), datetime(2020, 1, 6, 9, 0))
+        # day of month or day of week when both restricted
+        self.assertEqual(CronExpression('0 9 15 * 1').get_next(now), datetime(2020, 1, 6, 9, 0))
+        self.assertEqual(CronExpression('0 0 29 2 *').get_next(now), datetime(2020, 2, 29, 0, 0))
+        self.assertTrue(CronExpression('*/5 * * * *').match(datetime(2020, 1, 1, 10, 5)))
+
+
+    def test_3_skip_running(self):
+        setting = Setting()
+        setting['LOG_ENABLED'] = False
+        setting['DAEMON_WORKERS'] = 2
+        release = threading.Event()
+        runs = []
+
+        class BlockedDaemon(ServiceDaemon):
+            def run_service(self, service_name):
+                runs.append(service_name)
+                release.wait(5)
+        daemon = BlockedDaemon(setting)
+        try:
+            daemon.start('github')
+            future = daemon.running['github']
+            daemon.start('github')
+            self.assertIs(daemon.running['github'], future)
+            # other services are not blocked
+            daemon.start('gitee')
+            release.set()
+            future.result(5)
+            daemon.start('github')
+            self.assertIsNot(daemon.running['github'], future)
+            daemon.running['github'].result(5)
+            self.assertEqual(sorted(runs), ['gitee', 'github', 'github'])
+            # managers share the mirror limits per host
+            self.assertIs(daemon.managers['github'].mirror.host_limits, daemon.managers['gitee'].mirror.host_limits)
+        finally:
+            release.set()
+            daemon.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
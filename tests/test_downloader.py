@@ -0,0 +1,230 @@
+import unittest
+import os
+import time
+import tempfile
+from shutil import rmtree
+import sys
+sys.path.insert(0, '..')
+from requests.structures import CaseInsensitiveDict
+import requests
+from repository.downloader import Downloader, ResponseCache, Page, RateLimiter, RetryPolicy
+from repository.minisetting import Setting
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, headers=None, text=''):
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers if headers else {})
+        self.text = text
+
+    def close(self):
+        pass
+
+
+class FakeSession:
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.sent = 0
+
+    def request(self, method, url, **kwargs):
+        self.sent += 1
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+class FakeDownloader(Downloader):
+    """
+    Downloader answering from a list of responses, requests are recorded.
+    """
+    def __init__(self, setting, responses):
+        super().__init__(setting)
+        self.responses = list(responses)
+        self.sent = []
+
+    def send(self, method, url, headers=None, auth=None, json_data=None):
+        self.sent.append((method, url, dict(headers) if headers else {}))
+        return self.responses.pop(0)
+
+
+class  DownloaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.setting = Setting()
+        self.setting['LOG_ENABLED'] = False
+        self.cache_dir = tempfile.mkdtemp()
+        self.setting['CACHE_DIR'] = self.cache_dir
+
+    def tearDown(self):
+        rmtree(self.cache_dir)
+
+    def test_1_conditional_request(self):
+        url = 'https://api.github.com/users/d12y12/repos'
+        downloader = FakeDownloader(self.setting, [
+            FakeResponse(200, {'ETag': '"v1"', 'Link': 'next'}, '[1]'),
+            FakeResponse(304, {'X-RateLimit-Remaining': '10'}),
+            FakeResponse(200, {'Last-Modified': 'Wed, 01 Jan 2020 00:00:00 GMT'}, '[2]'),
+        ])
+        page = downloader.get(url)
+        self.assertEqual(page.text, '[1]')
+        self.assertFalse(page.from_cache)
+        # revalidated, body and headers come from cache
+        page = downloader.get(url)
+        self.assertEqual(downloader.sent[1][2]['If-None-Match'], '"v1"')
+        self.assertTrue(page.from_cache)
+        self.assertEqual(page.status_code, 200)
+        self.assertEqual(page.text, '[1]')
+        self.assertEqual(page.headers['Link'], 'next')
+        self.assertEqual(page.headers['X-RateLimit-Remaining'], '10')
+        # changed, cache replaced
+        page = downloader.get(url, auth=('other', 'token'))
+        self.assertEqual(page.text, '[2]')
+        self.assertEqual(downloader.cache.get(url)['last_modified'], 'Wed, 01 Jan 2020 00:00:00 GMT')
+
+    def test_2_not_cached(self):
+        self.setting['HTTP_CACHE_ENABLED'] = False
+        downloader = FakeDownloader(self.setting, [FakeResponse(200, {'ETag': '"v1"'}, 'a'),
+                                                   FakeResponse(200, {'ETag': '"v1"'}, 'a')])
+        downloader.get('http://example.com/')
+        downloader.get('http://example.com/')
+        self.assertNotIn('If-None-Match', downloader.sent[1][2])
+        # responses without validator or failed are not cached
+        self.setting['HTTP_CACHE_ENABLED'] = True
+        downloader = FakeDownloader(self.setting, [FakeResponse(200, {}, 'a'), FakeResponse(404, {'ETag': '"v"'})])
+        downloader.get('http://example.com/a')
+        self.assertFalse(downloader.get('http://example.com/b'))
+        self.assertFalse(os.listdir(self.cache_dir))
+
+    def test_3_cache_evict(self):
+        self.setting['HTTP_CACHE_MAX_SIZE'] = 1100
+        cache = ResponseCache(self.setting)
+        page = Page('', 200, {'ETag': '"v"'}, 'x' * 200)
+        for i in range(3):
+            cache.put('http://example.com/{}'.format(i), page)
+            os.utime(cache.get_path('http://example.com/{}'.format(i)), (i, i))
+        self.assertLessEqual(cache.size, 1100)
+        # used recently, evicted last
+        cache.get('http://example.com/0')
+        cache.put('http://example.com/3', page)
+        self.assertLessEqual(cache.size, 990)
+        self.assertEqual(cache.size, cache.get_size())
+        self.assertTrue(cache.get('http://example.com/0'))
+        self.assertIsNone(cache.get('http://example.com/1'))
+        self.assertTrue(cache.get('http://example.com/2'))
+        self.assertTrue(cache.get('http://example.com/3'))
+
+    def test_4_rate_limit_headers(self):
+        limiter = RateLimiter(self.setting)
+        key = ('api.github.com', 'token', 'core')
+        self.assertEqual(limiter.get_headroom(key), float('inf'))
+        reset = str(int(time.time()) + 3600)
+        self.assertFalse(limiter.update(key, 200, {'X-RateLimit-Remaining': '4000', 'X-RateLimit-Reset': reset}))
+        self.assertEqual(limiter.get_headroom(key), 4000)
+        self.assertEqual(limiter.acquire(key), 0)
+        self.assertEqual(limiter.get_headroom(key), 3999)
+        # exhausted, rejected request is sent again after reset
+        self.assertTrue(limiter.update(key, 403, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': reset}))
+        self.assertEqual(limiter.get_headroom(key), -1)
+        self.assertGreater(limiter.get_wait(limiter.budgets[key], time.time()), 3500)
+        # budget refilled after reset
+        limiter.budgets[key]['reset'] = time.time() - 1
+        self.assertEqual(limiter.get_headroom(key), float('inf'))
+
+    def test_5_rate_limit_retry_after(self):
+        limiter = RateLimiter(self.setting)
+        key = ('gitee.com', '', 'core')
+        self.assertTrue(limiter.update(key, 429, {'Retry-After': '30'}))
+        self.assertAlmostEqual(limiter.get_wait(limiter.budgets[key], time.time()), 30, delta=1)
+        key = ('api.github.com', '', 'core')
+        self.assertTrue(limiter.update(key, 403, {}, 'You have exceeded a secondary rate limit'))
+        self.assertAlmostEqual(limiter.get_wait(limiter.budgets[key], time.time()), 60, delta=1)
+        # forbidden for other reasons is not rate limit
+        key = ('api.github.com', 'other', 'core')
+        self.assertFalse(limiter.update(key, 403, {}, 'Bad credentials'))
+        self.assertEqual(limiter.get_headroom(key), float('inf'))
+
+    def test_6_rate_limit_reserve(self):
+        self.setting['RATE_LIMIT_RESERVE'] = 100
+        limiter = RateLimiter(self.setting)
+        key = ('api.github.com', 'token', 'core')
+        now = time.time()
+        limiter.update(key, 200, {'X-RateLimit-Remaining': '10', 'X-RateLimit-Reset': str(int(now) + 100)})
+        limiter.budgets[key]['last'] = now
+        # under reserve, remaining requests are spread until reset
+        self.assertAlmostEqual(limiter.get_wait(limiter.budgets[key], now), 10, delta=1)
+
+    def test_7_retry_policy(self):
+        self.setting['REQUESTS_RETRY_TIMES'] = 3
+        self.setting['REQUESTS_RETRY_DEADLINE'] = 60
+        policy = RetryPolicy(self.setting)
+        start = time.monotonic()
+        for status_code in (429, 502, 503, 504):
+            self.assertIsNotNone(policy.get_wait(0, start, status_code=status_code))
+        for status_code in (200, 304, 403, 404, 500):
+            self.assertIsNone(policy.get_wait(0, start, status_code=status_code))
+        self.assertIsNotNone(policy.get_wait(0, start, error=requests.exceptions.ConnectTimeout()))
+        self.assertIsNone(policy.get_wait(0, start, error=requests.exceptions.InvalidURL()))
+        # full jitter under the capped exponential backoff
+        for attempt in range(3):
+            wait = policy.get_wait(attempt, start, status_code=503)
+            self.assertLessEqual(wait, min(self.setting['REQUESTS_RETRY_MAX_INTERVAL'],
+                                           self.setting['REQUESTS_RETRY_INTERVAL'] * 2 ** attempt))
+        self.assertIsNone(policy.get_wait(3, start, status_code=503))
+        # past deadline
+        self.assertIsNone(policy.get_wait(0, start - 61, status_code=503))
+        self.setting['REQUESTS_RETRY_ENABLED'] = False
+        self.assertIsNone(policy.get_wait(0, start, status_code=503))
+
+    def test_8_send_retry(self):
+        self.setting['REQUESTS_RETRY_INTERVAL'] = 0.01
+        downloader = Downloader(self.setting)
+        downloader.session = FakeSession([requests.exceptions.ConnectionError(), FakeResponse(503),
+                                          FakeResponse(200, text='ok')])
+        self.assertEqual(downloader.send('GET', 'http://example.com/').text, 'ok')
+        self.assertEqual(downloader.session.sent, 3)
+        downloader.session = FakeSession([FakeResponse(404), FakeResponse(200)])
+        self.assertEqual(downloader.send('GET', 'http://example.com/').status_code, 404)
+        self.assertEqual(downloader.session.sent, 1)
+        # rate limit waits don't use up retry deadline
+        self.setting['REQUESTS_RETRY_DEADLINE'] = 0.2
+
+        def acquire(key):
+            time.sleep(0.3)
+            return 0.3
+        downloader.rate_limiter.acquire = acquire
+        downloader.session = FakeSession([FakeResponse(503), FakeResponse(200)])
+        self.assertEqual(downloader.send('GET', 'http://example.com/').status_code, 200)
+
+
+    def test_9_token_choice(self):
+        downloader = Downloader(self.setting)
+        tokens = [('a', 'token_a'), ('b', 'token_b'), ('c', 'token_c')]
+        downloader.tokens['github'] = tokens
+        url = 'https://api.github.com/users/d12y12/repos'
+        # quota unknown, tokens used in turn
+        self.assertEqual(sorted(downloader.get_auth('github', url) for _ in range(3)), tokens)
+        reset = str(int(time.time()) + 3600)
+        for (user, token), remaining in zip(tokens, ('100', '4000', '0')):
+            downloader.rate_limiter.update(downloader.get_rate_key(url, (user, token)),
+                                           200 if remaining != '0' else 403,
+                                           {'X-RateLimit-Remaining': remaining, 'X-RateLimit-Reset': reset})
+        for _ in range(3):
+            self.assertEqual(downloader.get_auth('github', url), ('b', 'token_b'))
+        # graphql has its own budget
+        graphql = 'https://api.github.com/graphql'
+        downloader.rate_limiter.update(downloader.get_rate_key(graphql, tokens[1]), 200,
+                                       {'X-RateLimit-Remaining': '10', 'X-RateLimit-Reset': reset})
+        downloader.rate_limiter.update(downloader.get_rate_key(graphql, tokens[2]), 200,
+                                       {'X-RateLimit-Remaining': '20', 'X-RateLimit-Reset': reset})
+        self.assertEqual(downloader.get_auth('github', graphql), ('a', 'token_a'))
+        downloader.rate_limiter.update(downloader.get_rate_key(graphql, tokens[0]), 200,
+                                       {'X-RateLimit-Remaining': '5', 'X-RateLimit-Reset': reset})
+        self.assertEqual(downloader.get_auth('github', graphql), ('c', 'token_c'))
+        # one token or none
+        downloader.tokens['gitee'] = []
+        self.assertEqual(downloader.get_auth('gitee', 'https://gitee.com/api/v5/users/d12y12/repos'), ())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,15 +1,24 @@
 import unittest
 import os
-from os.path import join, dirname, abspath, exists, isdir
+from os.path import join, dirname, abspath, exists, isdir, basename
 from shutil import copy, rmtree
 from os import remove, listdir
 from hashlib import md5
 import json
 import filecmp
 import sys
+import tempfile
+import threading
+import subprocess
+from unittest import mock
 sys.path.insert(0, '..')
 from repository import RepositoryManager
 from repository.minisetting import Setting
+from repository import mirror as repository_mirror
+from repository.mirror import RepositoryMirror, MirrorScheduler, HostLimits
+from concurrent.futures import ThreadPoolExecutor, Future
+from repository.parser import RepositoryParser
+from repository.store import RepositoryStore, Repository, close_connections
 import time
 
 def onerror(func, path, exc_info):
@@ -134,5 +143,458 @@ class  MirrorTest(unittest.TestCase):
             if exists(dst_dir):
                 rmtree(dst_dir, onerror=onerror)
 
+
+class FakeMirror(RepositoryMirror):
+    """
+    Mirror without git, records mirrored names.
+    """
+    def mirror(self, data_dir='', repository=None, error_callback=None):
+        time.sleep(0.01)
+        with self.failed_lock:
+            self.mirrored.append(repository['name'])
+        return True
+
+
+class  SyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.setting = Setting()
+        self.setting['LOG_ENABLED'] = False
+        self.setting['MIRROR_WORKERS'] = 8
+        self.setting['MIRROR_HOST_LIMIT'] = 4
+        self.setting['MIRROR_QUEUE_SIZE'] = 2
+        self.setting['MAINTENANCE_ENABLED'] = False
+        self.temp_dir = tempfile.mkdtemp()
+        self.data_dir = join(self.temp_dir, 'data')
+        os.makedirs(self.data_dir)
+        self.sqlite_file = join(self.temp_dir, 'sync.db')
+        self.store = RepositoryStore(self.setting)
+        self.store.create(join(dirname(abspath(__file__)), "test_data", "github.sql"), self.sqlite_file)
+        self.repositories = []
+        for i in range(30):
+            repository = Repository()
+            repository['name'] = 'repo{}'.format(i)
+            repository['html_url'] = 'https://github.com/d12y12/repo{}'.format(i)
+            repository['clone_url'] = 'https://github.com/d12y12/repo{}.git'.format(i)
+            repository['source'] = 'd12y12'
+            repository['source_type'] = 'index'
+            self.repositories.append(repository)
+        list(self.store.add_repositories(self.sqlite_file, self.repositories))
+
+    def tearDown(self):
+        close_connections(self.sqlite_file)
+        rmtree(self.temp_dir, onerror=onerror)
+
+    def run_sync(self, mirror, incoming):
+        result = {}
+
+        def run():
+            try:
+                mirror.sync(data_dir=self.data_dir, database=self.sqlite_file, incoming=incoming)
+            except Exception as e:
+                result['error'] = e
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(30)
+        self.assertFalse(thread.is_alive(), "sync hangs")
+        return result
+
+    def test_1_single_host(self):
+        # one host, more repositories than host limit and workers
+        mirror = FakeMirror(self.setting)
+        result = self.run_sync(mirror, iter(self.repositories))
+        self.assertFalse(result)
+        self.assertEqual(sorted(mirror.mirrored), sorted(repository['name'] for repository in self.repositories))
+
+    def test_2_producer_stopped(self):
+        closed = threading.Event()
+
+        def incoming():
+            try:
+                yield from self.repositories
+            finally:
+                closed.set()
+
+        class FailedMirror(FakeMirror):
+            def process_result(self, store, database, repository, future):
+                raise RuntimeError("failed")
+        result = self.run_sync(FailedMirror(self.setting), incoming())
+        self.assertIsInstance(result['error'], RuntimeError)
+        self.assertTrue(closed.wait(5))
+
+    def test_3_unchanged_not_updated(self):
+        class UnchangedMirror(FakeMirror):
+            def mirror(self, data_dir='', repository=None, error_callback=None):
+                repository['fetched'] = repository['name'] != 'repo0'
+                return True
+        connection = self.store.open(self.sqlite_file)
+        connection.execute("UPDATE Repositories SET last_update='2020-01-01 00:00:00', "
+                           "last_check='2020-01-01 00:00:00'")
+        connection.commit()
+        UnchangedMirror(self.setting).sync(data_dir=self.data_dir, database=self.sqlite_file)
+        repositories = {repository['name']: repository
+                        for repository in self.store.get_repository_list(self.sqlite_file)}
+        self.assertEqual(repositories['repo0']['last_update'], '2020-01-01 00:00:00')
+        self.assertNotEqual(repositories['repo0']['last_check'], '2020-01-01 00:00:00')
+        self.assertNotEqual(repositories['repo1']['last_update'], '2020-01-01 00:00:00')
+
+
+    def test_4_mirror_while_parsing(self):
+        class SlowParser(RepositoryParser):
+            """
+            Index of 3 pages, 5 repositories each.
+            """
+            def get_source_type(self, meta_source, error_callback=None):
+                meta_source['source_type'] = 'index'
+                return meta_source
+
+            def matches_excludes(self, meta):
+                return False
+
+            def parse_index(self, meta_source, error_callback=None):
+                for page in range(3):
+                    time.sleep(0.3)
+                    for i in range(5):
+                        meta_repository = meta_source.partial_copy()
+                        meta_repository['name'] = 'slow{}'.format(page * 5 + i)
+                        meta_repository['url'] = 'https://example.com/slow{}'.format(page * 5 + i)
+                        meta_repository['clone_url'] = 'https://example.com/slow{}.git'.format(page * 5 + i)
+                        yield meta_repository
+        times = {}
+
+        class TimedMirror(FakeMirror):
+            def mirror(self, data_dir='', repository=None, error_callback=None):
+                times.setdefault('mirror', time.monotonic())
+                return super().mirror(data_dir, repository, error_callback)
+
+        def incoming():
+            yield from SlowParser(self.setting).parse([{'source': 'slow', 'excludes': [], 'targets': []}],
+                                                      self.sqlite_file)
+            times['parsed'] = time.monotonic()
+        mirror = TimedMirror(self.setting)
+        self.assertFalse(self.run_sync(mirror, incoming()))
+        self.assertLess(times['mirror'], times['parsed'] - 0.3)
+        self.assertEqual(len(mirror.mirrored), 45)
+
+    def test_5_fingerprint_skip(self):
+        class FingerprintMirror(RepositoryMirror):
+            def get_ref_fingerprint(self, clone_url):
+                return 'fingerprint'
+        mirror = FingerprintMirror(self.setting)
+        repository = dict(self.repositories[0].to_dict(), ref_fingerprint='fingerprint')
+        os.makedirs(mirror.get_repository_path(self.data_dir, repository))
+        with mock.patch.object(repository_mirror.subprocess, 'run',
+                               return_value=subprocess.CompletedProcess([], 0, b'')) as run:
+            self.assertTrue(mirror.mirror(self.data_dir, repository))
+            self.assertFalse(repository['fetched'])
+            run.assert_not_called()
+            # refs changed
+            repository['ref_fingerprint'] = 'old'
+            self.assertTrue(mirror.mirror(self.data_dir, repository))
+            self.assertTrue(repository['fetched'])
+            self.assertEqual(repository['ref_fingerprint'], 'fingerprint')
+            self.assertIn('update', run.call_args_list[0][0][0])
+            # not mirrored yet
+            run.reset_mock()
+            repository = dict(self.repositories[1].to_dict(), ref_fingerprint='fingerprint')
+            self.assertTrue(mirror.mirror(self.data_dir, repository))
+            self.assertEqual(run.call_args_list[0][0][0][:3], ['git', 'clone', '--mirror'])
+
+
+class  CgitrcTest(unittest.TestCase):
+
+    def setUp(self):
+        self.setting = Setting()
+        self.setting['LOG_ENABLED'] = False
+        self.temp_dir = tempfile.mkdtemp()
+        self.data_dir = join(self.temp_dir, 'data')
+        self.sqlite_file = join(self.temp_dir, 'cgitrc.db')
+        self.cgitrc_file = join(self.temp_dir, 'github.repo')
+        self.store = RepositoryStore(self.setting)
+        self.store.create(join(dirname(abspath(__file__)), "test_data", "github.sql"), self.sqlite_file)
+        self.mirror = RepositoryMirror(self.setting)
+        # same name from two owners
+        repositories = []
+        for owner in ('d12y12', 'other'):
+            repository = Repository()
+            repository['name'] = 'temp'
+            repository['owner'] = owner
+            repository['section'] = owner
+            repository['html_url'] = 'https://github.com/{}/temp'.format(owner)
+            repository['clone_url'] = 'https://github.com/{}/temp.git'.format(owner)
+            repository['source'] = owner + '/temp'
+            repository['source_type'] = 'repository'
+            repositories.append(repository)
+            os.makedirs(self.mirror.get_repository_path(self.data_dir, repository))
+        list(self.store.add_repositories(self.sqlite_file, repositories))
+
+    def tearDown(self):
+        close_connections(self.sqlite_file)
+        rmtree(self.temp_dir, onerror=onerror)
+
+    def generate(self):
+        return self.mirror.generate_cgitrc(self.data_dir, self.sqlite_file, 'http://localhost/github',
+                                           self.cgitrc_file)
+
+    def test_1_duplicate_names(self):
+        self.assertTrue(self.generate())
+        with open(self.cgitrc_file, 'r', encoding='utf-8') as f:
+            entries = f.read().split('\n\n')
+        self.assertIn('repo.url=temp\n', entries[0])
+        self.assertIn('repo.clone-url=http://localhost/github/temp https://github.com/d12y12/temp.git\n', entries[0])
+        self.assertIn('repo.url=other.temp\n', entries[1])
+        self.assertIn('repo.name=temp\n', entries[1])
+        self.assertIn('repo.clone-url=http://localhost/github/other.temp https://github.com/other/temp.git\n',
+                      entries[1])
+
+    def test_2_write_if_changed(self):
+        self.assertTrue(self.generate())
+        self.assertEqual(os.stat(self.cgitrc_file).st_mode & 0o777, 0o644)
+        os.chmod(self.cgitrc_file, 0o640)
+        stat = os.stat(self.cgitrc_file)
+        # same content, file untouched
+        self.assertFalse(self.generate())
+        self.assertEqual(os.stat(self.cgitrc_file).st_ino, stat.st_ino)
+        self.assertEqual(os.stat(self.cgitrc_file).st_mtime_ns, stat.st_mtime_ns)
+        # changed, replaced with mode kept
+        connection = self.store.open(self.sqlite_file)
+        connection.execute("UPDATE Repositories SET descriptions='changed'")
+        connection.commit()
+        self.assertTrue(self.generate())
+        self.assertNotEqual(os.stat(self.cgitrc_file).st_ino, stat.st_ino)
+        self.assertEqual(os.stat(self.cgitrc_file).st_mode & 0o777, 0o640)
+        with open(self.cgitrc_file, 'r', encoding='utf-8') as f:
+            self.assertIn('repo.desc=changed\n', f.read())
+        # no temporary file left
+        self.assertFalse([name for name in listdir(self.temp_dir) if name.startswith('.github.repo')])
+
+
+class  QuarantineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.setting = Setting()
+        self.setting['LOG_ENABLED'] = False
+        self.setting['MIRROR_WORKERS'] = 4
+        self.temp_dir = tempfile.mkdtemp()
+        self.source_dir = join(self.temp_dir, 'data', 'source')
+        self.backup_dir = join(self.temp_dir, 'backup')
+
+    def tearDown(self):
+        rmtree(self.temp_dir, onerror=onerror)
+
+    def test_1_quarantine(self):
+        repositories = []
+        for name in ('a.git', 'b.git', 'c.git'):
+            os.makedirs(join(self.source_dir, name))
+            with open(join(self.source_dir, name, 'HEAD'), 'w') as f:
+                f.write(name)
+            repositories.append(join(self.source_dir, name))
+        # moved before, kept
+        os.makedirs(join(self.backup_dir, 'source', 'a.git'))
+        repositories.append(join(self.source_dir, 'missing.git'))
+        mirror = RepositoryMirror(self.setting)
+        mirror.quarantine(repositories, self.backup_dir)
+        self.assertFalse(listdir(self.source_dir))
+        backups = sorted(listdir(join(self.backup_dir, 'source')))
+        self.assertEqual(len(backups), 4)
+        self.assertEqual(backups[0], 'a.git')
+        self.assertRegex(backups[1], r'^a\.git_\d{8}_\d{6}$')
+        self.assertEqual(backups[2:], ['b.git', 'c.git'])
+        self.assertFalse(listdir(join(self.backup_dir, 'source', 'a.git')))
+        with open(join(self.backup_dir, 'source', backups[1], 'HEAD')) as f:
+            self.assertEqual(f.read(), 'a.git')
+        # failed moves reported
+        self.assertEqual(len(mirror.failed_list), 1)
+        self.assertIn('missing.git', mirror.failed_list[0])
+
+
+class MaintainedMirror(RepositoryMirror):
+    """
+    Mirror without git maintenance, records maintained names.
+    """
+    def __init__(self, setting, delay=0, errors=()):
+        super().__init__(setting)
+        self.maintained = []
+        self.delay = delay
+        self.errors = errors
+
+    def get_maintenance_tasks(self):
+        return []
+
+    def maintain_repository(self, repo_dir, tasks):
+        time.sleep(self.delay)
+        name = basename(repo_dir)[:-len('.git')]
+        self.maintained.append(name)
+        return 'failed' if name in self.errors else ''
+
+
+class  MaintenanceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.setting = Setting()
+        self.setting['LOG_ENABLED'] = False
+        self.setting['MIRROR_WORKERS'] = 1
+        self.temp_dir = tempfile.mkdtemp()
+        self.data_dir = join(self.temp_dir, 'data')
+        os.makedirs(self.data_dir)
+        self.sqlite_file = join(self.temp_dir, 'maintenance.db')
+        self.store = RepositoryStore(self.setting)
+        self.store.create(join(dirname(abspath(__file__)), "test_data", "github.sql"), self.sqlite_file)
+        # name: (packs, fetch count), nodir has no local mirror
+        self.repositories = {'packs': (3, 0), 'fetched': (1, 5), 'idle': (1, 1), 'loose': (0, 9),
+                             'recent': (5, 5), 'nodir': (5, 5)}
+        for name, (packs, fetch_count) in self.repositories.items():
+            repository = Repository()
+            repository['name'] = name
+            repository['html_url'] = 'https://github.com/d12y12/' + name
+            repository['clone_url'] = 'https://github.com/d12y12/{}.git'.format(name)
+            repository['source'] = 'd12y12'
+            repository['source_type'] = 'index'
+            repository_id = self.store.add_repository(self.sqlite_file, repository)
+            connection = self.store.open(self.sqlite_file)
+            connection.execute("UPDATE Repositories SET fetch_count=? WHERE id=?", (fetch_count, repository_id))
+            connection.commit()
+            if name == 'nodir':
+                continue
+            pack_dir = join(RepositoryMirror(self.setting).get_repository_path(self.data_dir, repository),
+                            'objects', 'pack')
+            os.makedirs(pack_dir)
+            for i in range(packs):
+                open(join(pack_dir, 'pack-{}.pack'.format(i)), 'w').close()
+        connection.execute("UPDATE Repositories SET last_maintenance=datetime('now','localtime') "
+                           "WHERE name='recent'")
+        connection.commit()
+
+    def tearDown(self):
+        close_connections(self.sqlite_file)
+        rmtree(self.temp_dir, onerror=onerror)
+
+    def get_repositories(self):
+        return {repository['name']: repository for repository in self.store.get_repository_list(self.sqlite_file)}
+
+    def test_1_priority(self):
+        mirror = MaintainedMirror(self.setting, errors=('idle',))
+        mirror.maintain(self.data_dir, self.sqlite_file)
+        # most packs first, then most fetches
+        self.assertEqual(mirror.maintained, ['packs', 'fetched', 'idle', 'loose'])
+        repositories = self.get_repositories()
+        for name in ('packs', 'fetched', 'loose'):
+            self.assertTrue(repositories[name]['last_maintenance'])
+            self.assertEqual(repositories[name]['fetch_count'], 0)
+        # failed ones are tried again next time
+        self.assertIsNone(repositories['idle']['last_maintenance'])
+        self.assertEqual(repositories['idle']['fetch_count'], 1)
+        self.assertEqual(len(mirror.failed_list), 1)
+        # maintained within MAINTENANCE_INTERVAL
+        mirror = MaintainedMirror(self.setting)
+        mirror.maintain(self.data_dir, self.sqlite_file)
+        self.assertEqual(mirror.maintained, ['idle'])
+        self.setting['MAINTENANCE_INTERVAL'] = 0
+        mirror.maintained = []
+        time.sleep(1)
+        mirror.maintain(self.data_dir, self.sqlite_file)
+        self.assertEqual(mirror.maintained, ['recent', 'packs', 'fetched', 'idle', 'loose'])
+
+    def test_2_time_budget(self):
+        self.setting['MAINTENANCE_TIME_BUDGET'] = 0.1
+        mirror = MaintainedMirror(self.setting, delay=0.2)
+        mirror.maintain(self.data_dir, self.sqlite_file)
+        self.assertEqual(mirror.maintained, ['packs'])
+        repositories = self.get_repositories()
+        self.assertTrue(repositories['packs']['last_maintenance'])
+        self.assertIsNone(repositories['fetched']['last_maintenance'])
+
+    @unittest.skipIf(repository_mirror.fcntl is None, "no file lock")
+    def test_3_still_running(self):
+        with open(join(self.data_dir, '.maintenance.lock'), 'w') as lock:
+            repository_mirror.fcntl.flock(lock, repository_mirror.fcntl.LOCK_EX | repository_mirror.fcntl.LOCK_NB)
+            mirror = MaintainedMirror(self.setting)
+            mirror.maintain(self.data_dir, self.sqlite_file)
+        self.assertEqual(mirror.maintained, [])
+        mirror.maintain(self.data_dir, self.sqlite_file)
+        self.assertEqual(len(mirror.maintained), 4)
+
+
+class RecordingExecutor:
+    """
+    Executor recording submitted jobs, futures are completed by the test.
+    """
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, fn, *args):
+        future = Future()
+        self.submitted.append((args[-1], future))
+        return future
+
+
+class  SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.peak = {}
+        self.order = []
+
+    def job(self, host, item):
+        with self.lock:
+            self.order.append(item)
+            self.in_flight[host] = self.in_flight.get(host, 0) + 1
+            self.peak[host] = max(self.peak.get(host, 0), self.in_flight[host])
+        time.sleep(0.02)
+        with self.lock:
+            self.in_flight[host] -= 1
+
+    def test_1_shared_host_limits(self):
+        # two services mirroring from one host at once
+        host_limits = HostLimits(2)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            schedulers = [MirrorScheduler(executor, 4, host_limits=host_limits) for _ in range(2)]
+            for index, scheduler in enumerate(schedulers):
+                for i in range(6):
+                    scheduler.add('github.com', (index, i), self.job, 'github.com', (index, i))
+            threads = [threading.Thread(target=lambda scheduler=scheduler: list(scheduler.run()))
+                       for scheduler in schedulers]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(10)
+        self.assertEqual(len(self.order), 12)
+        self.assertEqual(self.peak['github.com'], 2)
+
+    def test_2_round_robin(self):
+        executor = RecordingExecutor()
+        scheduler = MirrorScheduler(executor, workers=4, host_limit=2)
+        for host, count in (('a', 4), ('b', 2), ('c', 1)):
+            for i in range(count):
+                scheduler.add(host, host + str(i), self.job, host, host + str(i))
+        scheduler.dispatch()
+        # hosts take turns
+        self.assertEqual([item for item, _ in executor.submitted], ['a0', 'b0', 'c0', 'a1'])
+        futures = dict(executor.submitted)
+        futures['b0'].set_result(True)
+        self.assertEqual([item for item, _ in scheduler.completed()], ['b0'])
+        scheduler.dispatch()
+        self.assertEqual(executor.submitted[-1][0], 'b1')
+        # a has host_limit jobs in flight
+        futures['c0'].set_result(True)
+        list(scheduler.completed())
+        scheduler.dispatch()
+        self.assertEqual(len(executor.submitted), 5)
+        futures['a0'].set_result(True)
+        list(scheduler.completed())
+        scheduler.dispatch()
+        self.assertEqual(executor.submitted[-1][0], 'a2')
+
+    def test_3_host_limit(self):
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            scheduler = MirrorScheduler(executor, workers=8, host_limit=2)
+            for host in ('github.com', 'gitee.com', 'git.yoctoproject.org'):
+                for i in range(6):
+                    scheduler.add(host, (host, i), self.job, host, (host, i))
+            self.assertEqual(len(list(scheduler.run())), 18)
+        self.assertEqual(self.peak, {'github.com': 2, 'gitee.com': 2, 'git.yoctoproject.org': 2})
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -3,11 +3,20 @@ from os.path import join, dirname, abspath, exists, isdir
 from shutil import copy, rmtree
 from os import remove, listdir
 import json
+import importlib.util
+import re
 import time
 import sys
+import tempfile
 sys.path.insert(0, '..')
+from requests.structures import CaseInsensitiveDict
+from bs4 import SoupStrainer
 from repository import RepositoryManager
 from repository.minisetting import Setting
+from repository.downloader import Downloader
+from repository import parser as repository_parser
+from repository.parser import Meta, Cgit, GitHub
+from repository.store import RepositoryStore, close_connections
 
 
 class  ParserTest(unittest.TestCase):
@@ -36,6 +45,9 @@ class  ParserTest(unittest.TestCase):
             del repo['id']
             del repo['last_check']
             del repo['last_update']
+            del repo['ref_fingerprint']
+            del repo['last_maintenance']
+            del repo['fetch_count']
             repos_db_reform.append(repo)
         self.assertEqual(repos, repos_db_reform)
         remove("./yocto.json")
@@ -64,6 +76,9 @@ class  ParserTest(unittest.TestCase):
             del repo['id']
             del repo['last_check']
             del repo['last_update']
+            del repo['ref_fingerprint']
+            del repo['last_maintenance']
+            del repo['fetch_count']
             repos_db_reform.append(repo)
         self.assertEqual(repos, repos_db_reform)
         remove("./github.json")
@@ -92,6 +107,9 @@ class  ParserTest(unittest.TestCase):
             del repo['id']
             del repo['last_check']
             del repo['last_update']
+            del repo['ref_fingerprint']
+            del repo['last_maintenance']
+            del repo['fetch_count']
             repos_db_reform.append(repo)
         self.assertEqual(repos, repos_db_reform)
         remove("./gitee.json")
@@ -124,5 +142,340 @@ class  ParserTest(unittest.TestCase):
         if exists(dst_dir):
             rmtree(dst_dir)
 
+
+class StubResponse:
+    def __init__(self, status_code=200, text='', headers=None):
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers if headers else {})
+        self.text = text
+
+
+class StubDownloader(Downloader):
+    """
+    Downloader answering from pages, requests are recorded.
+
+    :param pages: {url: text, (text, headers) or function(json_data) returning text}, others are 404
+    """
+    def __init__(self, setting, pages):
+        super().__init__(setting)
+        self.pages = pages
+        self.sent = []
+        # seconds each request takes
+        self.delay = 0
+
+    def send(self, method, url, headers=None, auth=None, json_data=None):
+        time.sleep(self.delay)
+        self.sent.append((method, url))
+        page = self.pages.get(url)
+        if page is None:
+            return StubResponse(404, 'not found')
+        if isinstance(page, tuple):
+            return StubResponse(200, page[0], page[1])
+        return StubResponse(200, page(json_data) if callable(page) else page)
+
+
+def cgit_index(names, offset, page_size):
+    """
+    Cgit index page of names, a section every 3 repositories.
+    """
+    html = ["<html><body><div id='cgit'>"
+            "<table summary='repository info' class='tabs'><tr><td class='active'>index</td></tr></table>",
+            "<table summary='repository list' class='list nowrap'><tr class='nohover'><th class='left'>Name</th>"
+            "<th class='left'>Description</th><th class='left'>Owner</th><th class='left'>Idle</th></tr>"]
+    section = None
+    for name in names[offset:offset + page_size]:
+        if section != names.index(name) // 3:
+            section = names.index(name) // 3
+            html.append("<tr class='nohover-highlight'><td colspan='4' class='reposection'>"
+                        "section{}</td></tr>".format(section))
+        html.append("<tr><td class='sublevel-repo'><a href='/cgit/{0}/'>{0}</a></td><td>desc of {0}</td>"
+                    "<td>owner</td><td>2 days</td></tr>".format(name))
+    html.append("</table>")
+    if len(names) > page_size:
+        html.append("<ul class='pager'>")
+        for page_offset in range(0, len(names), page_size):
+            html.append("<li><a href='/cgit/?ofs={}'>[{}]</a></li>".format(page_offset, page_offset // page_size + 1))
+        html.append("</ul>")
+    html.append("</div></body></html>")
+    return "\n".join(html)
+
+
+def cgit_summary(name):
+    return ("<table summary='repository info' class='tabs'><tr><td class='active'>summary</td></tr></table>"
+            "<table id='header'><tr><td class='main'><a href='/cgit/'>index</a> : {0}</td></tr>"
+            "<tr><td class='sub'>desc of {0}</td><td class='sub right'>owner</td></tr></table>"
+            "<table summary='repository info' class='list nowrap'>"
+            "<tr class='nohover'><th class='left' colspan='4'>Clone</th></tr>"
+            "<tr><td colspan='4'><a rel='vcs-git' href='https://git.example.com/git/{0}'>"
+            "https://git.example.com/git/{0}</a></td></tr></table>").format(name)
+
+
+class  ParserStubTest(unittest.TestCase):
+
+    def setUp(self):
+        self.setting = Setting()
+        self.setting['LOG_ENABLED'] = False
+        self.setting['HTTP_CACHE_ENABLED'] = False
+
+    def new_sources(self, sources):
+        return [{'source': source, 'excludes': [], 'targets': []} for source in sources]
+
+    def test_1_github_graphql(self):
+        self.setting['GITHUB_GRAPHQL_ENABLED'] = True
+        self.setting['GITHUB_GRAPHQL_BATCH_SIZE'] = 2
+        queries = []
+
+        def graphql(json_data):
+            queries.append(json_data['query'])
+            # unknown repositories are null
+            data = {}
+            for alias, name in re.findall(r'(r\d+): repository\(owner: "d12y12", name: "(\w+)"\)', queries[-1]):
+                data[alias] = None if name == 'missing' else {
+                    'name': name, 'owner': {'login': 'd12y12'}, 'description': 'desc',
+                    'url': 'https://github.com/d12y12/' + name}
+            return json.dumps({'data': data})
+        downloader = StubDownloader(self.setting, {GitHub.GRAPHQL_URL: graphql})
+        downloader.tokens['github'] = [('d12y12', 'token')]
+        parser = GitHub(self.setting, downloader)
+        sources = self.new_sources(['d12y12/repo_a', 'd12y12/repo_b', 'd12y12/missing'])
+        repositories = list(parser.parse_sources(sources))
+        # one query per batch, no rest request
+        self.assertEqual(len(queries), 2)
+        self.assertEqual([method for method, _ in downloader.sent], ['POST', 'POST'])
+        self.assertEqual([repository['name'] for repository in repositories], ['repo_a', 'repo_b'])
+        self.assertEqual(repositories[0]['clone_url'], 'https://github.com/d12y12/repo_a.git')
+
+    def test_2_github_graphql_fallback(self):
+        self.setting['GITHUB_GRAPHQL_ENABLED'] = True
+        repository = {'name': 'repo_a', 'owner': {'login': 'd12y12'}, 'description': 'desc',
+                      'html_url': 'https://github.com/d12y12/repo_a',
+                      'clone_url': 'https://github.com/d12y12/repo_a.git'}
+        downloader = StubDownloader(self.setting, {
+            GitHub.GRAPHQL_URL: json.dumps({'errors': [{'message': 'bad credentials'}]}),
+            'https://api.github.com/repos/d12y12/repo_a': json.dumps(repository)})
+        downloader.tokens['github'] = [('d12y12', 'token')]
+        repositories = list(GitHub(self.setting, downloader).parse_sources(self.new_sources(['d12y12/repo_a'])))
+        self.assertEqual(downloader.sent, [('POST', GitHub.GRAPHQL_URL),
+                                           ('GET', 'https://api.github.com/repos/d12y12/repo_a')])
+        self.assertEqual(repositories[0]['clone_url'], 'https://github.com/d12y12/repo_a.git')
+        # no token, rest only
+        downloader.tokens['github'] = []
+        downloader.sent = []
+        list(GitHub(self.setting, downloader).parse_sources(self.new_sources(['d12y12/repo_a'])))
+        self.assertEqual(downloader.sent, [('GET', 'https://api.github.com/repos/d12y12/repo_a')])
+
+
+    def test_3_cgit_index_table(self):
+        html = cgit_index(['repo{}'.format(i) for i in range(5)], 0, 50)
+        meta_index = Meta()
+        meta_index['source'] = 'https://git.example.com/cgit/'
+        parsers = ['html.parser', 'lxml'] if importlib.util.find_spec('lxml') else ['html.parser']
+        html_parser = repository_parser.HTML_PARSER
+        try:
+            for repository_parser.HTML_PARSER in parsers:
+                parser = Cgit(self.setting, StubDownloader(self.setting, {}))
+                self.assertIsNone(parser.get_soup(html, SoupStrainer(['table', 'ul'])).find('div'))
+                soup = parser.get_index_soup(html)
+                # strainer only pays off with lxml
+                self.assertEqual(soup.find('div') is None, repository_parser.HTML_PARSER == 'lxml')
+                table = soup.find('table', attrs={'class': 'list nowrap'})
+                meta_repositories, offset_page = parser.parse_index_table(meta_index, table)
+                # section rows are not counted for offset
+                self.assertEqual(offset_page, 5)
+                self.assertEqual([meta['name'] for meta in meta_repositories], ['repo{}'.format(i) for i in range(5)])
+                self.assertEqual([meta['section'] for meta in meta_repositories],
+                                 ['section0'] * 3 + ['section1'] * 2)
+                self.assertEqual(meta_repositories[4]['descriptions'], 'desc of repo4')
+                self.assertEqual(meta_repositories[4]['owner'], 'owner')
+                self.assertEqual(meta_repositories[4]['url'], 'https://git.example.com/cgit/repo4/')
+        finally:
+            repository_parser.HTML_PARSER = html_parser
+
+
+    def new_index_row(self, template):
+        meta_repository = Meta()
+        meta_repository['source'] = 'https://git.example.com/cgit/'
+        meta_repository['clone_url_template'] = template
+        meta_repository['name'] = 'poky'
+        meta_repository['section'] = 'yocto'
+        meta_repository['url'] = 'https://git.example.com/cgit/yocto/poky/'
+        return meta_repository
+
+    def test_4_cgit_clone_url_template(self):
+        parser = Cgit(self.setting, StubDownloader(self.setting, {}))
+        self.assertEqual(parser.get_template_clone_url(self.new_index_row('https://git.example.com/git/{path}')),
+                         'https://git.example.com/git/yocto/poky')
+        self.assertEqual(parser.get_template_clone_url(self.new_index_row('git://git.example.com/{name}.git')),
+                         'git://git.example.com/poky.git')
+        self.assertEqual(parser.get_template_clone_url(self.new_index_row('')), '')
+        self.assertEqual(parser.get_template_clone_url(self.new_index_row('https://git.example.com/{user}')), '')
+        # valid clone url from template, summary page not fetched
+        refs = 'https://git.example.com/git/yocto/poky/info/refs?service=git-upload-pack'
+        downloader = StubDownloader(self.setting, {refs: ''})
+        meta_repository = Cgit(self.setting, downloader).parse_index_repository(
+            self.new_index_row('https://git.example.com/git/{path}'))
+        self.assertEqual(downloader.sent, [('HEAD', refs)])
+        self.assertEqual(meta_repository['clone_url'], 'https://git.example.com/git/yocto/poky')
+        self.assertFalse(meta_repository['error'])
+        # not valid, clone url from summary page
+        summary = 'https://git.example.com/cgit/yocto/poky/'
+        downloader = StubDownloader(self.setting, {summary: cgit_summary('poky')})
+        meta_repository = Cgit(self.setting, downloader).parse_index_repository(
+            self.new_index_row('https://git.example.com/git/{path}'))
+        self.assertEqual(downloader.sent, [('HEAD', refs), ('GET', summary)])
+        self.assertEqual(meta_repository['clone_url'], 'https://git.example.com/git/poky')
+        self.assertFalse(meta_repository['error'])
+
+
+    def test_5_cgit_pager(self):
+        names = ['repo{}'.format(i) for i in range(120)]
+        parser = Cgit(self.setting, StubDownloader(self.setting, {}))
+        soup = parser.get_soup(cgit_index(names, 0, 50), SoupStrainer(['table', 'ul']))
+        self.assertEqual(parser.get_pager_offsets(soup, 50), [50, 100])
+        self.assertEqual(parser.get_pager_offsets(soup, 100), [100])
+        soup = parser.get_soup(cgit_index(names[:10], 0, 50), SoupStrainer(['table', 'ul']))
+        self.assertEqual(parser.get_pager_offsets(soup, 10), [])
+        # index pages after the first one are downloaded at once
+        source = 'https://git.example.com/cgit/'
+        pages = {source: cgit_index(names, 0, 50)}
+        for offset in range(0, 150, 50):
+            pages[source + '?ofs={}'.format(offset)] = cgit_index(names, offset, 50)
+        for name in names:
+            pages['https://git.example.com/git/{}/info/refs?service=git-upload-pack'.format(name)] = ''
+        downloader = StubDownloader(self.setting, pages)
+        parser = Cgit(self.setting, downloader)
+        repositories = list(parser.parse_sources([{'source': source, 'excludes': [], 'targets': [],
+                                                   'clone_url_template': 'https://git.example.com/git/{path}'}]))
+        # rows of index pages are parsed concurrently
+        self.assertEqual(sorted(repository['name'] for repository in repositories), sorted(names))
+        index_urls = [url for method, url in downloader.sent if method == 'GET']
+        self.assertEqual(sorted(index_urls), [source, source + '?ofs=0', source + '?ofs=100', source + '?ofs=50'])
+        self.assertFalse(parser.failed_list)
+
+
+    def test_6_github_incremental(self):
+        self.setting['PARSE_INCREMENTAL'] = True
+        url = 'https://api.github.com/users/d12y12/repos?page={}&sort=updated&direction=desc'
+
+        def repo(name, updated_at):
+            return {'name': name, 'owner': {'login': 'd12y12'}, 'description': '', 'updated_at': updated_at,
+                    'html_url': 'https://github.com/d12y12/' + name,
+                    'clone_url': 'https://github.com/d12y12/{}.git'.format(name)}
+        pages = {url.format(1): json.dumps([repo('new', '2026-10-03T00:00:00Z'), repo('old', '2026-09-01T00:00:00Z')]),
+                 url.format(2): json.dumps([repo('older', '2026-08-01T00:00:00Z')]),
+                 url.format(3): '[]'}
+        sources = self.new_sources(['d12y12'])
+        # stop at watermark of last parse
+        downloader = StubDownloader(self.setting, pages)
+        parser = GitHub(self.setting, downloader)
+        parser.watermarks = {'github:d12y12': ('2026-10-01T00:00:00Z', int(time.time()))}
+        repositories = list(parser.parse_sources(sources))
+        self.assertEqual([repository['name'] for repository in repositories], ['new'])
+        self.assertEqual(downloader.sent, [('GET', url.format(1))])
+        self.assertEqual(parser.new_watermarks['github:d12y12'][0], '2026-10-03T00:00:00Z')
+        # full scan when due
+        downloader = StubDownloader(self.setting, pages)
+        parser = GitHub(self.setting, downloader)
+        parser.watermarks = {'github:d12y12': ('2026-10-01T00:00:00Z', 1)}
+        repositories = list(parser.parse_sources(sources))
+        self.assertEqual([repository['name'] for repository in repositories], ['new', 'old', 'older'])
+        self.assertEqual(len(downloader.sent), 3)
+        self.assertGreater(parser.new_watermarks['github:d12y12'][1], 1)
+        # no watermark saved if a page failed
+        del pages[url.format(2)]
+        parser = GitHub(self.setting, StubDownloader(self.setting, pages))
+        list(parser.parse_sources(sources))
+        self.assertFalse(parser.new_watermarks)
+
+
+    def test_7_watermark_write_failed(self):
+        self.setting['PARSE_INCREMENTAL'] = True
+        self.setting['DATABASE_BATCH_SIZE'] = 1
+        temp_dir = tempfile.mkdtemp()
+        sqlite_file = join(temp_dir, 'watermark.db')
+        store = RepositoryStore(self.setting)
+        store.create(join(dirname(abspath(__file__)), "test_data", "github.sql"), sqlite_file)
+        connection = store.open(sqlite_file)
+        connection.execute("CREATE TRIGGER fail_bad BEFORE INSERT ON Repositories WHEN NEW.name='bad' "
+                           "BEGIN SELECT RAISE(ABORT, 'bad repository'); END")
+        connection.commit()
+        pages = {}
+        for owner, names in (('d12y12', ['good', 'bad']), ('other', ['fine'])):
+            url = 'https://api.github.com/users/{}/repos?page={{}}&sort=updated&direction=desc'.format(owner)
+            pages[url.format(1)] = json.dumps([
+                {'name': name, 'owner': {'login': owner}, 'description': '', 'updated_at': '2026-10-01T00:00:00Z',
+                 'html_url': 'https://github.com/{}/{}'.format(owner, name),
+                 'clone_url': 'https://github.com/{}/{}.git'.format(owner, name)} for name in names])
+            pages[url.format(2)] = '[]'
+        try:
+            parser = GitHub(self.setting, StubDownloader(self.setting, pages))
+            repositories = list(parser.parse(self.new_sources(['d12y12', 'other']), sqlite_file))
+            self.assertEqual(sorted(repository['name'] for repository in repositories), ['fine', 'good'])
+            self.assertIn('write to database failed', parser.failed_list['d12y12'][0]['error'])
+            # repositories not stored are parsed again next time
+            self.assertEqual(list(store.get_watermarks(sqlite_file)), ['github:other'])
+        finally:
+            close_connections(sqlite_file)
+            rmtree(temp_dir)
+
+
+    def test_8_consumer_closed(self):
+        self.setting['PARSE_CONCURRENCY'] = 2
+        url = 'https://api.github.com/users/d12y12/repos?page={}'
+        pages = {}
+        for page in range(1, 11):
+            pages[url.format(page)] = json.dumps([{
+                'name': 'repo{}'.format(page), 'owner': {'login': 'd12y12'}, 'description': '',
+                'html_url': 'https://github.com/d12y12/repo{}'.format(page),
+                'clone_url': 'https://github.com/d12y12/repo{}.git'.format(page)}])
+        downloader = StubDownloader(self.setting, pages)
+        downloader.delay = 0.2
+        parser = GitHub(self.setting, downloader)
+        sources = self.new_sources(['d12y12'] + ['d12y12/repo{}'.format(i) for i in range(10)])
+        repositories = parser.parse_sources(sources)
+        self.assertEqual(next(repositories)['name'], 'repo1')
+        start = time.monotonic()
+        repositories.close()
+        # index walk stops at next page, queued steps are dropped
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertLess(len(downloader.sent), 8)
+
+
+    def test_9_github_page_count(self):
+        parser = GitHub(self.setting, StubDownloader(self.setting, {}))
+        meta_index = Meta()
+        for headers, count in (({'Link': '<https://api.github.com/user/1/repos?page=2>; rel="next", '
+                                          '<https://api.github.com/user/1/repos?page=34>; rel="last"'}, 34),
+                               ({'total_page': '7'}, 7),
+                               ({'total_count': '201'}, 3),
+                               ({'Link': '<https://api.github.com/user/1/repos?page=1>; rel="prev"'}, 0),
+                               ({}, 0)):
+            meta_index['headers'] = CaseInsensitiveDict(headers)
+            self.assertEqual(parser.get_page_count(meta_index, 100), count)
+        # remaining pages are downloaded at once, later ones first
+        url = 'https://api.github.com/users/d12y12/repos?page={}'
+
+        def page(number):
+            text = json.dumps([{'name': 'repo{}_{}'.format(number, i), 'owner': {'login': 'd12y12'},
+                                'description': '', 'html_url': 'https://github.com/d12y12/repo{}_{}'.format(number, i),
+                                'clone_url': 'https://github.com/d12y12/repo{}_{}.git'.format(number, i)}
+                               for i in range(2)])
+
+            def delayed(json_data):
+                time.sleep(0.05 * (6 - number))
+                return text
+            return delayed
+        pages = {url.format(number): page(number) for number in range(2, 6)}
+        pages[url.format(1)] = (page(1)(None), {'Link': '<{}>; rel="last"'.format(url.format(5))})
+        downloader = StubDownloader(self.setting, pages)
+        start = time.monotonic()
+        repositories = list(GitHub(self.setting, downloader).parse_sources(self.new_sources(['d12y12'])))
+        # 0.5s one by one
+        self.assertLess(time.monotonic() - start, 0.45)
+        self.assertEqual([repository['name'] for repository in repositories],
+                         ['repo{}_{}'.format(number, i) for number in range(1, 6) for i in range(2)])
+        self.assertEqual(sorted(url for _, url in downloader.sent), [url.format(number) for number in range(1, 6)])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,199 @@
+import unittest
+from os.path import join, dirname, abspath, exists
+from os import remove
+import sys
+import sqlite3
+import threading
+sys.path.insert(0, '..')
+from repository import store
+from repository.store import RepositoryStore, Repository
+from repository.minisetting import Setting
+
+
+class  StoreTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.setting = Setting()
+        cls.setting['LOG_ENABLED'] = False
+        cls.test_data_dir = join(dirname(abspath(__file__)), "test_data")
+        cls.sql_file = join(cls.test_data_dir, "github.sql")
+        cls.sqlite_file = join(cls.setting['DATABASE_DIR'], "store_test.db")
+
+    def setUp(self):
+        self.store = RepositoryStore(self.setting)
+        self.store.create(self.sql_file, self.sqlite_file)
+
+    def tearDown(self):
+        self.store.close(self.sqlite_file)
+        if exists(self.sqlite_file):
+            remove(self.sqlite_file)
+
+    def new_repository(self, name, source_type='index'):
+        repository = Repository()
+        repository['name'] = name
+        repository['html_url'] = 'https://github.com/d12y12/' + name
+        repository['clone_url'] = 'https://github.com/d12y12/' + name + '.git'
+        repository['source'] = 'd12y12'
+        repository['source_type'] = source_type
+        return repository
+
+    def test_1_connection_reused(self):
+        connection = self.store.open(self.sqlite_file)
+        self.assertIs(connection, RepositoryStore(self.setting).open(self.sqlite_file))
+        repository_id = self.store.add_repository(self.sqlite_file, self.new_repository('temp'))
+        self.assertIsInstance(repository_id, int)
+        self.assertEqual(len(self.store.get_repository_list(self.sqlite_file)), 1)
+        self.assertIs(connection, self.store.open(self.sqlite_file))
+
+    def test_2_connection_closed(self):
+        connection = self.store.open(self.sqlite_file)
+        with RepositoryStore(self.setting) as store:
+            store.close(self.sqlite_file)
+            self.assertIsNot(connection, store.open(self.sqlite_file))
+        # closed on exit of context manager
+        self.assertIsNot(connection, self.store.open(self.sqlite_file))
+        # file replaced on disk
+        connection = self.store.open(self.sqlite_file)
+        remove(self.sqlite_file)
+        self.store.create(self.sql_file, self.sqlite_file)
+        self.assertIsNot(connection, self.store.open(self.sqlite_file))
+        self.assertFalse(self.store.get_repository_list(self.sqlite_file))
+
+    def test_3_schema_upgrade(self):
+        repository_id = self.store.add_repository(self.sqlite_file, self.new_repository('temp'))
+        self.store.update_mirror_state(self.sqlite_file, repository_id, 'fingerprint')
+        repository = self.store.get_repository_list(self.sqlite_file)[0]
+        self.assertEqual(repository['ref_fingerprint'], 'fingerprint')
+        self.assertTrue(repository['last_update'])
+        self.assertEqual(repository['fetch_count'], 1)
+        self.store.update_mirror_state(self.sqlite_file, repository_id, 'fingerprint')
+        self.store.update_mirror_state(self.sqlite_file, repository_id, '')
+        self.assertEqual(self.store.get_repository_list(self.sqlite_file)[0]['fetch_count'], 2)
+        self.store.update_maintenance(self.sqlite_file, repository_id)
+        repository = self.store.get_repository_list(self.sqlite_file)[0]
+        self.assertEqual(repository['fetch_count'], 0)
+        self.assertTrue(repository['last_maintenance'])
+        # database managed columns are not compared for duplicate
+        self.assertEqual(self.store.add_repository(self.sqlite_file, self.new_repository('temp')), repository_id)
+
+    def test_4_add_repositories(self):
+        single = self.new_repository('single', 'repository')
+        single_id = self.store.add_repository(self.sqlite_file, single)
+        changed = self.new_repository('changed')
+        changed_id = self.store.add_repository(self.sqlite_file, changed)
+        changed = self.new_repository('changed')
+        changed['descriptions'] = 'changed'
+        repositories = [self.new_repository('repo{}'.format(i)) for i in range(5)]
+        repositories += [self.new_repository('repo0'), self.new_repository('single'), changed]
+        ret = list(self.store.add_repositories(self.sqlite_file, repositories, batch_size=3))
+        self.assertEqual(len(ret), 8)
+        self.assertTrue(all(isinstance(repository_id, int) for repository_id in ret[:5]))
+        self.assertEqual(ret[5], ret[0])
+        self.assertEqual(ret[6], {'merger': single.to_dict()})
+        self.assertEqual(ret[7]['duplicate']['descriptions'], '')
+        repos = {repo['name']: repo for repo in self.store.get_repository_list(self.sqlite_file)}
+        self.assertEqual(len(repos), 7)
+        self.assertEqual(repos['single']['id'], single_id)
+        self.assertEqual(repos['single']['source_type'], 'index')
+        self.assertEqual(repos['changed']['id'], changed_id)
+        self.assertEqual(repos['changed']['descriptions'], '')
+
+    def test_5_wal_journal(self):
+        connection = self.store.open(self.sqlite_file)
+        self.assertEqual(connection.execute("PRAGMA journal_mode").fetchone()[0], 'wal')
+        self.assertEqual(connection.execute("PRAGMA synchronous").fetchone()[0], 1)
+
+    def test_6_indexes(self):
+        connection = self.store.open(self.sqlite_file)
+        indexed = self.store.get_indexed_columns(connection.cursor(), 'Repositories')
+        self.assertTrue(indexed['clone_url'])
+        self.assertIn('source', indexed)
+        self.assertIn('last_update', indexed)
+        plan = connection.execute("EXPLAIN QUERY PLAN SELECT * FROM Repositories WHERE source=?",
+                                  ('d12y12',)).fetchall()
+        self.assertIn('idx_repositories_source', plan[0]['detail'])
+
+    def test_7_watermarks(self):
+        self.assertEqual(self.store.get_watermarks(self.sqlite_file), {})
+        self.store.update_watermark(self.sqlite_file, 'github:d12y12', '2020-01-01T00:00:00Z', 100)
+        self.store.update_watermark(self.sqlite_file, 'github:d12y12', '2020-02-01T00:00:00Z', 100)
+        self.assertEqual(self.store.get_watermarks(self.sqlite_file),
+                         {'github:d12y12': ('2020-02-01T00:00:00Z', 100)})
+
+    def test_8_iter_repository_list(self):
+        repositories = [self.new_repository('repo{}'.format(i)) for i in range(5)]
+        list(self.store.add_repositories(self.sqlite_file, repositories))
+        expected = self.store.get_repository_list(self.sqlite_file)
+        self.assertEqual(list(self.store.iter_repository_list(self.sqlite_file, batch_size=2)), expected)
+        names = list(self.store.iter_repository_list(self.sqlite_file, ('name',)))
+        self.assertEqual(names, [{'name': repo['name']} for repo in expected])
+
+    def test_9_move_database(self):
+        # another connection keeps -wal and -shm files
+        reader = sqlite3.connect(self.sqlite_file)
+        reader.execute("SELECT count(*) FROM Repositories").fetchall()
+        self.store.add_repository(self.sqlite_file, self.new_repository('wal'))
+        moved_file = self.sqlite_file + '.bak'
+        self.store.move_database(self.sqlite_file, moved_file)
+        reader.close()
+        for suffix in ('', '-wal', '-shm'):
+            self.assertFalse(exists(self.sqlite_file + suffix))
+        repositories = self.store.get_repository_list(moved_file)
+        self.assertEqual([repository['name'] for repository in repositories], ['wal'])
+        self.store.remove_database(moved_file)
+        for suffix in ('', '-wal', '-shm'):
+            self.assertFalse(exists(moved_file + suffix))
+
+    def test_10_thread_connections(self):
+        self.store.open(self.sqlite_file)
+        opened = []
+        closed = threading.Event()
+
+        def worker():
+            worker_store = RepositoryStore(self.setting)
+            opened.append(worker_store.open(self.sqlite_file))
+            closed.wait(5)
+            # close() of another thread leaves this connection alone
+            opened.append(len(worker_store.get_repository_list(self.sqlite_file)))
+        thread = threading.Thread(target=worker)
+        thread.start()
+        self.store.close(self.sqlite_file)
+        closed.set()
+        thread.join()
+        self.assertEqual(opened[1], 0)
+        key = (abspath(self.sqlite_file), thread.ident)
+        self.assertIn(key, store._connections)
+        # connections of ended threads are closed on next connect
+        self.store.open(self.sqlite_file)
+        self.assertNotIn(key, store._connections)
+
+
+    def test_11_add_repositories_not_unique(self):
+        # template without unique clone_url, duplicates already stored
+        self.store.remove_database(self.sqlite_file)
+        with open(self.sql_file, 'r') as f:
+            sql_script = f.read().replace('clone_url TEXT UNIQUE NOT NULL', 'clone_url TEXT NOT NULL')
+        connection = sqlite3.connect(self.sqlite_file)
+        connection.executescript(sql_script)
+        for source_type in ('repository', 'repository'):
+            repository = self.new_repository('dup', source_type)
+            connection.execute("INSERT INTO Repositories(name, section, owner, descriptions, html_url, clone_url, "
+                               "target_url, source, source_type, last_check) "
+                               "VALUES(?,?,?,?,?,?,?,?,?,datetime('now','localtime'))", repository.to_tuple())
+        connection.commit()
+        connection.close()
+        connection = self.store.open(self.sqlite_file)
+        self.assertFalse(self.store.get_indexed_columns(connection.cursor(), 'Repositories')['clone_url'])
+        repositories = [self.new_repository('repo0'), self.new_repository('repo0'), self.new_repository('dup')]
+        ret = list(self.store.add_repositories(self.sqlite_file, repositories))
+        self.assertIsInstance(ret[0], int)
+        self.assertEqual(ret[1], ret[0])
+        self.assertEqual(ret[2]['merger']['source_type'], 'repository')
+        repos = self.store.get_repository_list(self.sqlite_file)
+        self.assertEqual(len(repos), 3)
+        self.assertEqual(sorted(repo['source_type'] for repo in repos), ['index', 'index', 'repository'])
+
+
+if __name__ == '__main__':
+    unittest.main()
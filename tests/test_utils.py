@@ -4,7 +4,7 @@ from os import remove
 from shutil import copy
 import sys
 sys.path.insert(0, '..')
-from repository.utils import get_token, get_version, set_logger, config_logging
+from repository.utils import get_token, get_tokens, get_version, set_logger, config_logging
 from repository.minisetting import Setting
 
 
@@ -52,6 +52,18 @@ class  UtilsTest(unittest.TestCase):
         remove(join(dst_dir, "github_token"))
         remove(join(dst_dir, "gitee_token"))
 
+    def test_3_get_tokens(self):
+        test_data_dir = join(dirname(abspath(__file__)), "test_data")
+        dst_dir = dirname(dirname(abspath(__file__)))
+        self.assertEqual(get_tokens(token_type='github'), [])
+        # one token per line, wrong lines skipped
+        copy(join(test_data_dir, "multi_token"), join(dst_dir, "github_token"))
+        tokens = get_tokens(token_type='github')
+        self.assertEqual(tokens, [("d12y12", "123456"), ("d12y12", "654321"), ("other", "abcdef")])
+        token = get_token(token_type='github')
+        self.assertEqual(token, ("d12y12", "123456"))
+        remove(join(dst_dir, "github_token"))
+
     @classmethod
     def tearDownClass(cls):
         dst_dir = dirname(dirname(abspath(__file__)))